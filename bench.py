@@ -0,0 +1,931 @@
+# bench.py
+# Benchmarks of the IPPcode22 interpret (interpret.py)
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+from xml.sax.saxutils import escape
+
+#
+#
+# Generating programs
+#
+#
+
+
+# Build a XML representation of a program from a list of instructions, each
+# being a tuple of an opcode and a list of (type, text) tuples (arguments)
+def program_xml(instructions):
+    lines = ["<?xml version=\"1.0\" encoding=\"UTF-8\"?>",
+            "<program language=\"IPPcode22\">"]
+    for order, (opcode, args) in enumerate(instructions, 1):
+        lines.append("<instruction order=\"" + str(order)
+                + "\" opcode=\"" + opcode + "\">")
+        for i, (arg_type, text) in enumerate(args, 1):
+            lines.append("<arg" + str(i) + " type=\"" + arg_type + "\">"
+                    + escape(text) + "</arg" + str(i) + ">")
+        lines.append("</instruction>")
+    lines.append("</program>")
+    return "\n".join(lines) + "\n"
+
+
+# Build the source code (IPPcode22) of a program from a list of instructions
+# (see program_xml)
+def program_text(instructions):
+    lines = [".IPPcode22"]
+    for opcode, args in instructions:
+        words = [opcode]
+        for arg_type, text in args:
+            if arg_type in ["var", "label", "type"]:
+                words.append(text)
+            else:
+                words.append(arg_type + "@" + text)
+        lines.append(" ".join(words))
+    return "\n".join(lines) + "\n"
+
+
+# A counting loop placed after `padding` instructions which are jumped over,
+# so the loop runs far from the beginning of the instructions array. The
+# padding is jumped over by a JUMPIFEQ on the counter (which is only known at
+# run time), so it is reachable and kept by the elimination of dead code, or by
+# a JUMP if not `reachable` (so it is removed). Returns the program and the
+# amount of instructions executed
+def counting_loop(padding, iterations, reachable=True):
+    skip = ("JUMP", [("label", "start")])
+    if reachable:
+        skip = ("JUMPIFEQ", [("label", "start"), ("var", "GF@i"),
+            ("int", "0")])
+    instructions = [
+            ("DEFVAR", [("var", "GF@i")]),
+            ("MOVE",   [("var", "GF@i"), ("int", "0")]),
+            skip]
+    instructions += [("CREATEFRAME", [])] * padding
+    instructions += [
+            ("LABEL",     [("label", "start")]),
+            ("ADD",       [("var", "GF@i"), ("var", "GF@i"), ("int", "1")]),
+            ("JUMPIFNEQ", [("label", "start"), ("var", "GF@i"),
+                ("int", str(iterations))])]
+    return program_xml(instructions), 3 + 2 * iterations
+
+
+# A loop doing integer arithmetic and comparisons on variables. Returns the
+# program and the amount of instructions executed
+def arithmetic_loop(size, iterations):
+    instructions = [
+            ("DEFVAR", [("var", "GF@i")]),
+            ("MOVE",   [("var", "GF@i"), ("int", "0")]),
+            ("DEFVAR", [("var", "GF@x")]),
+            ("MOVE",   [("var", "GF@x"), ("int", "1")]),
+            ("DEFVAR", [("var", "GF@b")]),
+            ("LABEL",  [("label", "loop")]),
+            ("ADD",    [("var", "GF@x"), ("var", "GF@x"), ("var", "GF@i")]),
+            ("MUL",    [("var", "GF@x"), ("var", "GF@x"), ("int", "3")]),
+            ("IDIV",   [("var", "GF@x"), ("var", "GF@x"), ("int", "2")]),
+            ("SUB",    [("var", "GF@x"), ("var", "GF@x"), ("var", "GF@i")]),
+            ("IDIV",   [("var", "GF@x"), ("var", "GF@x"), ("int", "4")]),
+            ("LT",     [("var", "GF@b"), ("var", "GF@x"), ("int", "1000")]),
+            ("ADD",    [("var", "GF@i"), ("var", "GF@i"), ("int", "1")]),
+            ("JUMPIFNEQ", [("label", "loop"), ("var", "GF@i"),
+                ("int", str(iterations))])]
+    return program_xml(instructions), 5 + 9 * iterations
+
+
+# A loop of operations on literals and on global variables assigned once
+# (which can be folded to constants). Returns the program and the amount of
+# instructions executed
+def constant_loop(size, iterations):
+    instructions = [
+            ("DEFVAR", [("var", "GF@i")]),
+            ("MOVE",   [("var", "GF@i"), ("int", "0")]),
+            ("DEFVAR", [("var", "GF@n")]),
+            ("MOVE",   [("var", "GF@n"), ("int", str(iterations))]),
+            ("DEFVAR", [("var", "GF@k")]),
+            ("MOVE",   [("var", "GF@k"), ("int", "7")]),
+            ("DEFVAR", [("var", "GF@x")]),
+            ("DEFVAR", [("var", "GF@s")]),
+            ("DEFVAR", [("var", "GF@b")]),
+            ("LABEL",  [("label", "loop")]),
+            ("ADD",    [("var", "GF@x"), ("int", "2"), ("int", "3")]),
+            ("MUL",    [("var", "GF@x"), ("var", "GF@k"), ("int", "6")]),
+            ("CONCAT", [("var", "GF@s"), ("string", "a"), ("string", "b")]),
+            ("EQ",     [("var", "GF@b"), ("var", "GF@k"), ("int", "7")]),
+            ("ADD",    [("var", "GF@i"), ("var", "GF@i"), ("int", "1")]),
+            ("JUMPIFNEQ", [("label", "loop"), ("var", "GF@i"),
+                ("var", "GF@n")])]
+    return program_xml(instructions), 9 + 6 * iterations
+
+
+# A loop writing a string of `length` characters in every iteration. Returns
+# the program and the amount of characters written
+def writing_loop(length, iterations):
+    instructions = [
+            ("DEFVAR", [("var", "GF@i")]),
+            ("MOVE",   [("var", "GF@i"), ("int", "0")]),
+            ("LABEL",  [("label", "loop")]),
+            ("WRITE",  [("string", "x" * (length - 1) + "\\010")]),
+            ("ADD",    [("var", "GF@i"), ("var", "GF@i"), ("int", "1")]),
+            ("JUMPIFNEQ", [("label", "loop"), ("var", "GF@i"),
+                ("int", str(iterations))])]
+    return program_xml(instructions), length * iterations
+
+
+# A loop reading values of a type until the input ends (nil is read). Returns
+# the program
+def reading_loop(literal_type):
+    instructions = [
+            ("DEFVAR", [("var", "GF@x")]),
+            ("DEFVAR", [("var", "GF@t")]),
+            ("LABEL",  [("label", "loop")]),
+            ("READ",   [("var", "GF@x"), ("type", literal_type)]),
+            ("TYPE",   [("var", "GF@t"), ("var", "GF@x")]),
+            ("JUMPIFNEQ", [("label", "loop"), ("var", "GF@t"),
+                ("string", "nil")])]
+    return program_xml(instructions)
+
+
+# A long program of instructions which are never executed, used to measure the
+# load time. They are jumped over by a JUMPIFEQ on a variable which is also
+# changed by them (so its value is only known at run time) and every LABEL is
+# targeted, so all of them are reachable and kept by the elimination of dead
+# code. The program is formatted by the function provided (XML by default)
+def long_program(size, formatter=program_xml):
+    instructions = [
+            ("DEFVAR",   [("var", "GF@x")]),
+            ("MOVE",     [("var", "GF@x"), ("int", "0")]),
+            ("DEFVAR",   [("var", "GF@s")]),
+            ("MOVE",     [("var", "GF@s"), ("string", "")]),
+            ("JUMPIFEQ", [("label", "end"), ("var", "GF@x"), ("int", "0")])]
+    while len(instructions) < size - 2:
+        label = ("label", "l" + str(len(instructions)))
+        instructions += [
+                ("DEFVAR", [("var", "GF@v" + str(len(instructions)))]),
+                ("ADD",    [("var", "GF@x"), ("var", "GF@x"), ("int", "1")]),
+                ("CONCAT", [("var", "GF@s"), ("var", "GF@s"),
+                    ("string", "text\\032with\\010escapes")]),
+                ("LABEL",  [label]),
+                ("JUMPIFEQ", [label, ("var", "GF@s"), ("string", "output")])]
+    instructions += [
+            ("LABEL", [("label", "end")]),
+            ("EXIT",  [("int", "0")])]
+    return formatter(instructions)
+
+
+# A program (exiting right away) of `size` WRITE instructions of string
+# literals containing `escapes` escape sequences (of different characters)
+# each, of which only `distinct` literals differ
+def escaped_program(size, escapes, distinct, formatter=program_xml):
+    instructions = [("EXIT", [("int", "0")])]
+    for i in range(size):
+        literal = str(i % distinct) + "".join("a\\{:03}".format(j % 1000)
+                for j in range(escapes))
+        instructions.append(("WRITE", [("string", literal)]))
+    return formatter(instructions)
+
+
+# A loop building a string of `length` characters by CONCAT appending one
+# character at a time and another one replacing every one of its characters by
+# SETCHAR. Returns the program and the amount of instructions executed
+def building_loop(length):
+    instructions = [
+            ("DEFVAR",    [("var", "GF@s")]),
+            ("MOVE",      [("var", "GF@s"), ("string", "")]),
+            ("DEFVAR",    [("var", "GF@i")]),
+            ("MOVE",      [("var", "GF@i"), ("int", "0")]),
+            ("LABEL",     [("label", "build")]),
+            ("CONCAT",    [("var", "GF@s"), ("var", "GF@s"),
+                ("string", "a")]),
+            ("ADD",       [("var", "GF@i"), ("var", "GF@i"), ("int", "1")]),
+            ("JUMPIFNEQ", [("label", "build"), ("var", "GF@i"),
+                ("int", str(length))]),
+            ("MOVE",      [("var", "GF@i"), ("int", "0")]),
+            ("LABEL",     [("label", "replace")]),
+            ("SETCHAR",   [("var", "GF@s"), ("var", "GF@i"),
+                ("string", "b")]),
+            ("ADD",       [("var", "GF@i"), ("var", "GF@i"), ("int", "1")]),
+            ("JUMPIFNEQ", [("label", "replace"), ("var", "GF@i"),
+                ("int", str(length))]),
+            ("STRLEN",    [("var", "GF@i"), ("var", "GF@s")]),
+            ("WRITE",     [("var", "GF@i")])]
+    return program_xml(instructions), 8 + 6 * length
+
+
+# Workloads stressing specific parts of the interpret. Every one of them gets
+# an amount of iterations and returns the program, the amount of instructions
+# executed and the input of the program
+
+
+# A tight loop of ADD and JUMPIFNEQ
+def workload_loop(iterations):
+    source, steps = counting_loop(0, iterations)
+    return source, steps, ""
+
+
+# A recursive function (with its own local frame) called to a depth
+def workload_recursion(depth):
+    instructions = [
+            ("DEFVAR",      [("var", "GF@n")]),
+            ("MOVE",        [("var", "GF@n"), ("int", str(depth))]),
+            ("CALL",        [("label", "rec")]),
+            ("EXIT",        [("int", "0")]),
+            ("LABEL",       [("label", "rec")]),
+            ("CREATEFRAME", []),
+            ("PUSHFRAME",   []),
+            ("DEFVAR",      [("var", "LF@x")]),
+            ("MOVE",        [("var", "LF@x"), ("var", "GF@n")]),
+            ("SUB",         [("var", "GF@n"), ("var", "GF@n"), ("int", "1")]),
+            ("JUMPIFEQ",    [("label", "done"), ("var", "GF@n"),
+                ("int", "0")]),
+            ("CALL",        [("label", "rec")]),
+            ("LABEL",       [("label", "done")]),
+            ("POPFRAME",    []),
+            ("RETURN",      [])]
+    return program_xml(instructions), 10 * depth + 2, ""
+
+
+# Building a string by CONCAT while changing its characters by SETCHAR
+def workload_strings(iterations):
+    instructions = [
+            ("DEFVAR",    [("var", "GF@s")]),
+            ("MOVE",      [("var", "GF@s"), ("string", "x")]),
+            ("DEFVAR",    [("var", "GF@i")]),
+            ("MOVE",      [("var", "GF@i"), ("int", "0")]),
+            ("LABEL",     [("label", "loop")]),
+            ("CONCAT",    [("var", "GF@s"), ("var", "GF@s"),
+                ("string", "ab")]),
+            ("SETCHAR",   [("var", "GF@s"), ("var", "GF@i"),
+                ("string", "c")]),
+            ("ADD",       [("var", "GF@i"), ("var", "GF@i"), ("int", "1")]),
+            ("JUMPIFNEQ", [("label", "loop"), ("var", "GF@i"),
+                ("int", str(iterations))])]
+    return program_xml(instructions), 5 + 4 * iterations, ""
+
+
+# Pushing values to the data stack and popping them
+def workload_stack(iterations):
+    instructions = [
+            ("DEFVAR",    [("var", "GF@i")]),
+            ("MOVE",      [("var", "GF@i"), ("int", "0")]),
+            ("DEFVAR",    [("var", "GF@x")]),
+            ("DEFVAR",    [("var", "GF@s")]),
+            ("LABEL",     [("label", "loop")]),
+            ("PUSHS",     [("var", "GF@i")]),
+            ("PUSHS",     [("string", "a")]),
+            ("POPS",      [("var", "GF@s")]),
+            ("POPS",      [("var", "GF@x")]),
+            ("ADD",       [("var", "GF@i"), ("var", "GF@x"), ("int", "1")]),
+            ("JUMPIFNEQ", [("label", "loop"), ("var", "GF@i"),
+                ("int", str(iterations))])]
+    return program_xml(instructions), 5 + 6 * iterations, ""
+
+
+# Reading a line of input and writing it in every iteration
+def workload_io(iterations):
+    instructions = [
+            ("DEFVAR",    [("var", "GF@i")]),
+            ("MOVE",      [("var", "GF@i"), ("int", "0")]),
+            ("DEFVAR",    [("var", "GF@x")]),
+            ("LABEL",     [("label", "loop")]),
+            ("READ",      [("var", "GF@x"), ("type", "int")]),
+            ("WRITE",     [("var", "GF@x")]),
+            ("ADD",       [("var", "GF@i"), ("var", "GF@i"), ("int", "1")]),
+            ("JUMPIFNEQ", [("label", "loop"), ("var", "GF@i"),
+                ("int", str(iterations))])]
+    input_data = "".join(str(i) + "\n" for i in range(iterations))
+    return program_xml(instructions), 4 + 4 * iterations, input_data
+
+
+# Workloads by their names, along with the amount of iterations used
+WORKLOADS = {
+        "loop":      (workload_loop,      400000),
+        "recursion": (workload_recursion, 80000),
+        "strings":   (workload_strings,   40000),
+        "stack":     (workload_stack,     120000),
+        "io":        (workload_io,        200000),
+        }
+
+
+#
+#
+# Running programs
+#
+#
+
+
+# Run the interpret on a program and input (strings), return the wall time in
+# seconds, peak memory of the process in kilobytes and the exit code
+def run(interpret, source, input_data="", extra_args=[]):
+    with tempfile.TemporaryDirectory() as tmp:
+        source_path = os.path.join(tmp, "source.xml")
+        input_path = os.path.join(tmp, "input.txt")
+        with open(source_path, "w") as f:
+            f.write(source)
+        with open(input_path, "w") as f:
+            f.write(input_data)
+
+        cmd = [sys.executable, interpret, "--source", source_path,
+                "--input", input_path] + extra_args
+        return run_command(cmd)
+
+
+# Run a command, return the wall time in seconds, peak memory of the process in
+# kilobytes and the exit code
+def run_command(cmd):
+    start = time.perf_counter()
+    process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+    _, status, rusage = os.wait4(process.pid, 0)
+    elapsed = time.perf_counter() - start
+    if os.WIFEXITED(status):
+        code = os.WEXITSTATUS(status)
+    else:
+        code = -os.WTERMSIG(status)
+    return elapsed, rusage.ru_maxrss, code
+
+
+# Measure the time of a single executed instruction independently of the
+# startup and load time by running the program with two amounts of iterations
+# (the fastest of three runs of both, as the load time of large programs is
+# noisy)
+def step_cost(interpret, generator, size, iterations, extra_args=[]):
+    source_short, steps_short = generator(size, iterations)
+    source_long, steps_long = generator(size, iterations * 2)
+    time_short = min(run(interpret, source_short, "", extra_args)
+            for _ in range(3))[0]
+    time_long = min(run(interpret, source_long, "", extra_args)
+            for _ in range(3))[0]
+    return (time_long - time_short) / (steps_long - steps_short)
+
+
+#
+#
+# Benchmarks
+#
+#
+
+
+# Cost of a single step depending on the program size. Should stay the same
+# for all sizes
+def bench_step_throughput(interpret):
+    print("Step throughput (counting loop after N padding instructions)")
+    print("  {:>10} {:>14} {:>14}".format("N", "ns/step", "steps/s"))
+    for size in [100, 1000, 10000, 50000]:
+        cost = step_cost(interpret, counting_loop, size, 200000)
+        print("  {:>10} {:>14.0f} {:>14.0f}".format(
+            size, cost * 1e9, 1 / cost))
+
+
+# Cost of a single step of a loop doing integer arithmetic
+def bench_arithmetic(interpret):
+    print("Arithmetic loop (ADD, MUL, IDIV, SUB, LT, jumps)")
+    cost = step_cost(interpret, arithmetic_loop, 0, 20000)
+    print("  {:>14} {:>14}".format("ns/step", "steps/s"))
+    print("  {:>14.0f} {:>14.0f}".format(cost * 1e9, 1 / cost))
+
+
+# Cost of a single step of the arithmetic loop using different engines
+def bench_engines(interpret):
+    print("Arithmetic loop using different engines")
+    print("  {:>10} {:>14} {:>14}".format("engine", "ns/step", "steps/s"))
+    for engine in ["reference", "closure", "transpiled"]:
+        cost = step_cost(interpret, arithmetic_loop, 0, 20000,
+                ["--engine=" + engine])
+        print("  {:>10} {:>14.0f} {:>14.0f}".format(
+            engine, cost * 1e9, 1 / cost))
+
+
+# Python code loading a program from a XML file (sys.argv[1]) using the
+# interpret (sys.argv[2]) the way it was done before the streaming loader: the
+# whole file is read and parsed to a tree, which is then walked twice
+TREE_LOADER = """
+import sys, os
+import xml.etree.ElementTree as ET
+sys.path.insert(0, os.path.dirname(sys.argv[2]))
+import interpret
+xml_root = ET.fromstring(open(sys.argv[1], "rb").read())
+for elem in xml_root.iter():
+    pass
+instructions = []
+for xml_instr in xml_root:
+    instruction = interpret.Instruction(
+            xml_instr.attrib["opcode"], int(xml_instr.attrib["order"]))
+    instructions.append(instruction)
+    for xml_arg in xml_instr:
+        instruction.add_arg(xml_arg)
+    instruction.check_args()
+"""
+
+
+# Python code loading a program from a XML file (sys.argv[1]) using the
+# streaming loader of the interpret (sys.argv[2])
+STREAMING_LOADER = """
+import sys, os
+sys.path.insert(0, os.path.dirname(sys.argv[2]))
+import interpret
+instructions = interpret.load_xml(open(sys.argv[1], "rb"))
+"""
+
+
+# Python code loading and preparing a program from a XML file (sys.argv[1])
+# using the interpret (sys.argv[2]), prints the amount of instructions kept and
+# the memory still allocated by python afterwards (in bytes)
+PREPARED_SIZE = """
+import sys, os, gc, tracemalloc
+sys.path.insert(0, os.path.dirname(sys.argv[2]))
+import interpret
+tracemalloc.start()
+program = interpret.Program(None, interpret.load_xml(open(sys.argv[1], "rb")))
+gc.collect()
+print(len(program.instructions), tracemalloc.get_traced_memory()[0])
+"""
+
+
+# Load time and peak memory of loading a long program using the streaming
+# loader and the way it was done before (parsing the whole tree)
+def bench_load(interpret):
+    print("Loading a XML program (time and peak memory)")
+    print("  {:>10} {:>8} {:>10} {:>10} {:>10}".format(
+        "loader", "instrs", "XML MB", "seconds", "peak MB"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in [10000, 100000]:
+            source_path = os.path.join(tmp, "source.xml")
+            with open(source_path, "w") as f:
+                f.write(long_program(size))
+            xml_size = os.path.getsize(source_path) / 1e6
+            for loader, code in [("tree", TREE_LOADER),
+                    ("streaming", STREAMING_LOADER)]:
+                elapsed, rss, _ = run_command([sys.executable, "-c", code,
+                    source_path, os.path.abspath(interpret)])
+                print("  {:>10} {:>8} {:>10.1f} {:>10.2f} {:>10.1f}".format(
+                    loader, size, xml_size, elapsed, rss / 1e3))
+
+
+# Load time and peak memory of programs with many escaped string literals:
+# short ones, long ones and the same ones repeated
+def bench_literals(interpret):
+    print("Loading a XML program with escaped string literals")
+    print("  {:>10} {:>8} {:>8} {:>8} {:>10} {:>10}".format(
+        "literals", "instrs", "escapes", "distinct", "seconds", "peak MB"))
+    with tempfile.TemporaryDirectory() as tmp:
+        source_path = os.path.join(tmp, "source.xml")
+        for name, size, escapes, distinct in [
+                ("short", 100000, 4, 100000),
+                ("long", 100, 20000, 100),
+                ("repeated", 100000, 40, 10)]:
+            with open(source_path, "w") as f:
+                f.write(escaped_program(size, escapes, distinct))
+            elapsed, rss, _ = min(run_command([sys.executable, "-c",
+                STREAMING_LOADER, source_path, os.path.abspath(interpret)])
+                for _ in range(3))
+            print("  {:>10} {:>8} {:>8} {:>8} {:>10.2f} {:>10.1f}".format(
+                name, size, escapes, distinct, elapsed, rss / 1e3))
+
+
+# Startup time of a long program without a cache, with an empty cache (cold)
+# and with the program already cached (warm)
+def bench_cache(interpret):
+    print("Startup time using a cache of prepared programs")
+    print("  {:>10} {:>8} {:>10}".format("run", "instrs", "seconds"))
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for size in [10000, 100000]:
+            source = long_program(size)
+            for name, extra_args in [("no cache", []),
+                    ("cold", ["--cache-dir", os.path.join(cache_dir, "cold")]),
+                    ("warm", ["--cache-dir", os.path.join(cache_dir, "warm")])]:
+                if name == "warm":
+                    run(interpret, source, "", extra_args)
+                elapsed, _, _ = run(interpret, source, "", extra_args)
+                print("  {:>10} {:>8} {:>10.2f}".format(name, size, elapsed))
+
+
+# Startup time and peak memory of a long program loaded from XML and from its
+# source code (.IPPcode22, which doesn't need to be converted to XML first)
+def bench_text(interpret):
+    print("Loading a program from XML and source code (time and peak memory)")
+    print("  {:>10} {:>8} {:>10} {:>10} {:>10}".format(
+        "format", "instrs", "MB", "seconds", "peak MB"))
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in [10000, 100000]:
+            for name, formatter, file_name in [
+                    ("XML", program_xml, "source.xml"),
+                    ("source", program_text, "source.IPPcode22")]:
+                path = os.path.join(tmp, file_name)
+                with open(path, "w") as f:
+                    f.write(long_program(size, formatter))
+                elapsed, rss, _ = run_command([sys.executable, interpret,
+                    "--source", path, "--input", "/dev/null"])
+                print("  {:>10} {:>8} {:>10.1f} {:>10.2f} {:>10.1f}".format(
+                    name, size, os.path.getsize(path) / 1e6, elapsed,
+                    rss / 1e3))
+
+
+# Startup time and peak memory of a long program (1M instructions, which are
+# jumped over) loaded from XML and from bytecode (written by --emit-bytecode)
+def bench_bytecode(interpret):
+    print("Loading a program of 1M instructions (time and peak memory)")
+    print("  {:>10} {:>10} {:>10} {:>10}".format(
+        "format", "MB", "seconds", "peak MB"))
+    with tempfile.TemporaryDirectory() as tmp:
+        source_path = os.path.join(tmp, "source.xml")
+        with open(source_path, "w") as f:
+            f.write(long_program(1000000))
+        bytecode_path = os.path.join(tmp, "source.ippc")
+        elapsed, _, _ = run_command([sys.executable, interpret, "--source",
+            source_path, "--emit-bytecode", bytecode_path])
+        print("  {:>10} {:>10.1f} {:>10.2f} {:>10}".format("(emitting)",
+            os.path.getsize(bytecode_path) / 1e6, elapsed, ""))
+        for name, path in [("XML", source_path), ("bytecode", bytecode_path)]:
+            elapsed, rss, _ = run_command([sys.executable, interpret,
+                "--source", path, "--input", "/dev/null"])
+            print("  {:>10} {:>10.1f} {:>10.2f} {:>10.1f}".format(name,
+                os.path.getsize(path) / 1e6, elapsed, rss / 1e3))
+
+
+# Time of a program writing 10M characters (in lines of 10 and 100 characters)
+# with different sizes of the output buffer
+def bench_output(interpret):
+    print("Writing 10M characters (to /dev/null)")
+    print("  {:>8} {:>10} {:>10} {:>10}".format(
+        "line", "buffer", "engine", "seconds"))
+    for length in [10, 100]:
+        source, _ = writing_loop(length, 10000000 // length)
+        for buffer_size in [0, 1 << 20]:
+            for engine in ["reference", "transpiled"]:
+                elapsed, _, _ = run(interpret, source, "", [
+                    "--output-buffer=" + str(buffer_size),
+                    "--engine=" + engine])
+                print("  {:>8} {:>10} {:>10} {:>10.2f}".format(
+                    length, buffer_size, engine, elapsed))
+
+
+# Time of a program reading 1M lines of input as integers and strings
+def bench_input(interpret):
+    print("Reading 1M lines of input")
+    print("  {:>8} {:>10} {:>10}".format("type", "engine", "seconds"))
+    input_data = "".join(str(i) + "\n" for i in range(1000000))
+    for literal_type in ["int", "string"]:
+        source = reading_loop(literal_type)
+        for engine in ["reference", "transpiled"]:
+            elapsed, _, _ = run(interpret, source, input_data,
+                    ["--engine=" + engine])
+            print("  {:>8} {:>10} {:>10.2f}".format(
+                literal_type, engine, elapsed))
+
+
+# Time of running 200 small programs by separate processes of the interpret
+# and by a batch of the interpret (using 1 and 4 processes)
+def bench_batch(interpret):
+    print("Running 200 small programs")
+    print("  {:>16} {:>10}".format("run", "seconds"))
+    source, _ = arithmetic_loop(0, 100)
+    with tempfile.TemporaryDirectory() as tmp:
+        manifest_path = os.path.join(tmp, "manifest")
+        with open(manifest_path, "w") as manifest:
+            for i in range(200):
+                source_path = os.path.join(tmp, str(i) + ".xml")
+                with open(source_path, "w") as f:
+                    f.write(source)
+                manifest.write(source_path + " /dev/null "
+                        + os.path.join(tmp, str(i) + ".out") + "\n")
+
+        start = time.perf_counter()
+        for i in range(200):
+            run_command([sys.executable, interpret, "--source",
+                os.path.join(tmp, str(i) + ".xml"), "--input", "/dev/null"])
+        print("  {:>16} {:>10.2f}".format("processes",
+            time.perf_counter() - start))
+        for jobs in [1, 4]:
+            elapsed, _, _ = run_command([sys.executable, interpret,
+                "--batch", manifest_path, "--jobs", str(jobs)])
+            print("  {:>16} {:>10.2f}".format(
+                "batch (" + str(jobs) + " jobs)", elapsed))
+
+
+# Time of running a large program (20000 instructions jumped over) on 200 input
+# files by a batch of the interpret (loading the program for every input) and
+# by a fan-out of the interpret (loading it once), using 1 and 4 processes
+def bench_fanout(interpret):
+    print("Running a program of 20000 instructions on 200 inputs")
+    print("  {:>16} {:>10}".format("run", "seconds"))
+    source, _ = counting_loop(20000, 100)
+    with tempfile.TemporaryDirectory() as tmp:
+        source_path = os.path.join(tmp, "source.xml")
+        with open(source_path, "w") as f:
+            f.write(source)
+        inputs_path = os.path.join(tmp, "inputs")
+        os.mkdir(inputs_path)
+        manifest_path = os.path.join(tmp, "manifest")
+        with open(manifest_path, "w") as manifest:
+            for i in range(200):
+                input_path = os.path.join(inputs_path, str(i))
+                with open(input_path, "w") as f:
+                    f.write(str(i) + "\n")
+                manifest.write(source_path + " " + input_path + " "
+                        + os.path.join(tmp, str(i) + ".out") + "\n")
+
+        for jobs in [1, 4]:
+            elapsed, _, _ = run_command([sys.executable, interpret,
+                "--batch", manifest_path, "--jobs", str(jobs)])
+            print("  {:>16} {:>10.2f}".format(
+                "batch (" + str(jobs) + " jobs)", elapsed))
+            elapsed, _, _ = run_command([sys.executable, interpret,
+                "--source", source_path, "--inputs", inputs_path,
+                "--output", os.path.join(tmp, "outputs"), "--jobs",
+                str(jobs)])
+            print("  {:>16} {:>10.2f}".format(
+                "fan-out (" + str(jobs) + " jobs)", elapsed))
+
+
+# Python code running a program (sys.argv[1]) with input lines (sys.argv[3],
+# separated by spaces) arriving with a delay (sys.argv[4] seconds before every
+# line) many times (sys.argv[5]) using the interpret (sys.argv[2]): as
+# coroutines one after another (sequential) and all at once in one event loop
+# (concurrent). Without a delay, the coroutines are also compared with running
+# the program synchronously (Interpreter.run). Prints the times as JSON
+ASYNC_RUNNER = """
+import sys, os, io, json, time, asyncio
+sys.path.insert(0, os.path.dirname(sys.argv[2]))
+import interpret
+interpreter = interpret.Interpreter(open(sys.argv[1], "rb").read())
+lines = [line.encode() + b"\\n" for line in sys.argv[3].split()]
+delay, count = float(sys.argv[4]), int(sys.argv[5])
+
+class Writer:
+    def write(self, data):
+        pass
+
+    async def drain(self):
+        pass
+
+async def feed(reader):
+    for line in lines:
+        await asyncio.sleep(delay)
+        reader.feed_data(line)
+    reader.feed_eof()
+
+async def run_one():
+    reader = asyncio.StreamReader()
+    feeding = asyncio.ensure_future(feed(reader))
+    await interpreter.run_async(reader, Writer())
+    await feeding
+
+async def sequential():
+    for i in range(count):
+        await run_one()
+
+async def concurrent():
+    await asyncio.gather(*[run_one() for i in range(count)])
+
+times = {}
+if delay == 0:
+    start = time.perf_counter()
+    for i in range(count):
+        interpreter.input_stream = io.BytesIO(b"".join(lines))
+        interpreter.output_stream = io.StringIO()
+        interpreter.run()
+    times["synchronous"] = time.perf_counter() - start
+for name, main in [("sequential", sequential), ("concurrent", concurrent)]:
+    start = time.perf_counter()
+    asyncio.run(main())
+    times[name] = time.perf_counter() - start
+print(json.dumps(times))
+"""
+
+
+# Time of running 1000 programs reading 10 lines of input (and writing them) as
+# coroutines in one event loop, sequentially and concurrently. Every line
+# arrives with a delay (like from a network) or at once
+def bench_async(interpret):
+    print("Running 1000 programs reading 10 lines as coroutines")
+    print("  {:>8} {:>12} {:>10}".format("delay", "run", "seconds"))
+    source, _, input_data = workload_io(10)
+    with tempfile.TemporaryDirectory() as tmp:
+        source_path = os.path.join(tmp, "source.xml")
+        with open(source_path, "w") as f:
+            f.write(source)
+        for delay in [0, 0.001]:
+            result = subprocess.run([sys.executable, "-c", ASYNC_RUNNER,
+                source_path, os.path.abspath(interpret), input_data,
+                str(delay), "1000"], stdout=subprocess.PIPE, check=True)
+            for name, elapsed in json.loads(result.stdout).items():
+                print("  {:>8} {:>12} {:>10.2f}".format(
+                    str(delay * 1000) + " ms", name, elapsed))
+
+
+# Instructions and memory kept by a program jumping over a lot of unreachable
+# code and the time of its runs using different engines
+def bench_dead_code(interpret):
+    print("Program jumping over 200000 unreachable instructions")
+    source, _ = counting_loop(200000, 1000, reachable=False)
+    with tempfile.TemporaryDirectory() as tmp:
+        source_path = os.path.join(tmp, "source.xml")
+        with open(source_path, "w") as f:
+            f.write(source)
+        kept, memory = subprocess.run([sys.executable, "-c", PREPARED_SIZE,
+            source_path, os.path.abspath(interpret)], capture_output=True,
+            text=True).stdout.split()
+    print("  {:>10} {:>10}".format("instrs", "kept MB"))
+    print("  {:>10} {:>10.1f}".format(kept, int(memory) / 1e6))
+    print("  {:>10} {:>10}".format("engine", "seconds"))
+    for engine in ["reference", "closure", "transpiled"]:
+        elapsed, _, _ = min(run(interpret, source, "",
+            ["--engine=" + engine]) for _ in range(3))
+        print("  {:>10} {:>10.2f}".format(engine, elapsed))
+
+
+# Time per step of a loop of constant operations run by the closure engine
+# without and with constant folding and propagation (-O0 and -O1)
+def bench_folding(interpret):
+    print("Constant operations using the closure engine")
+    print("  {:>10} {:>14} {:>14}".format("level", "ns/step", "steps/s"))
+    source_short, steps_short = constant_loop(0, 1)
+    source_long, steps_long = constant_loop(0, 200000)
+    for level in ["-O0", "-O1"]:
+        extra_args = ["--engine=closure", level]
+        time_short = min(run(interpret, source_short, "", extra_args)
+                for _ in range(5))[0]
+        time_long = min(run(interpret, source_long, "", extra_args)
+                for _ in range(5))[0]
+        cost = (time_long - time_short) / (steps_long - steps_short)
+        print("  {:>10} {:>14.0f} {:>14.0f}".format(
+            level, cost * 1e9, 1 / cost))
+
+
+# Time of building a string by CONCAT and rewriting it by SETCHAR, which is
+# linear in its length when the strings are kept in mutable buffers
+def bench_buffers(interpret):
+    print("Building a string by CONCAT and rewriting it by SETCHAR")
+    engines = ["reference", "closure", "transpiled"]
+    print("  {:>10}".format("chars") + "".join(
+        " {:>11}".format(engine) for engine in engines))
+    for length in [1 << 14, 1 << 16, 1 << 20]:
+        source, _ = building_loop(length)
+        times = [min(run(interpret, source, "", ["--engine=" + engine])
+            for _ in range(3))[0] for engine in engines]
+        print("  {:>10}".format(length) + "".join(
+            " {:>10.2f}s".format(elapsed) for elapsed in times))
+
+
+# Steps per second and peak memory of all workloads. The startup and load time
+# is measured by running a workload with a single iteration and subtracted (the
+# fastest of five runs is used for both, so the noise doesn't cause false
+# regressions). Returns the results by names of the workloads
+def bench_workloads(interpret):
+    print("Workloads")
+    print("  {:>10} {:>14} {:>10}".format("workload", "steps/s", "peak MB"))
+    results = {}
+    for name, (generator, iterations) in WORKLOADS.items():
+        source_short, steps_short, input_short = generator(1)
+        source_long, steps_long, input_long = generator(iterations)
+        runs_short = [run(interpret, source_short, input_short)
+                for _ in range(5)]
+        runs_long = [run(interpret, source_long, input_long)
+                for _ in range(5)]
+        time_short = min(runs_short)[0]
+        time_long, rss, _ = min(runs_long)
+        results[name] = {
+                "steps_per_second":
+                    (steps_long - steps_short) / (time_long - time_short),
+                "peak_memory_mb": rss / 1e3}
+        print("  {:>10} {:>14.0f} {:>10.1f}".format(name,
+            results[name]["steps_per_second"],
+            results[name]["peak_memory_mb"]))
+    return results
+
+
+# Time per step of the workloads run by the closure engine without and with
+# the fusion of superinstructions (-O0 and -O1)
+def bench_fusion(interpret):
+    print("Workloads using the closure engine with superinstructions")
+    print("  {:>10} {:>12} {:>12} {:>10}".format("workload", "-O0 ns/step",
+        "-O1 ns/step", "speedup"))
+    for name in ["loop", "recursion", "strings", "stack"]:
+        generator, iterations = WORKLOADS[name]
+        source_short, steps_short, input_short = generator(1)
+        source_long, steps_long, input_long = generator(iterations)
+        costs = []
+        for level in ["-O0", "-O1"]:
+            extra_args = ["--engine=closure", level]
+            time_short = min(run(interpret, source_short, input_short,
+                extra_args) for _ in range(3))[0]
+            time_long = min(run(interpret, source_long, input_long,
+                extra_args) for _ in range(3))[0]
+            costs.append((time_long - time_short) / (steps_long - steps_short))
+        print("  {:>10} {:>12.0f} {:>12.0f} {:>9.2f}x".format(name,
+            costs[0] * 1e9, costs[1] * 1e9, costs[0] / costs[1]))
+
+
+# Compare results of benchmarks with a baseline (results of an earlier run),
+# print the differences and return whether the steps per second dropped or the
+# peak memory grew by more than the threshold (in percents)
+def compare_baseline(results, baseline, threshold):
+    print("Comparison with the baseline (threshold " + str(threshold) + " %)")
+    print("  {:>10} {:>16} {:>14} {:>12}".format(
+        "workload", "metric", "change [%]", ""))
+    regressed = False
+    for benchmark, benchmark_results in results.items():
+        for name, result in benchmark_results.items():
+            if name not in baseline.get(benchmark, {}):
+                continue
+            base = baseline[benchmark][name]
+            speed = 100 * (result["steps_per_second"]
+                    / base["steps_per_second"] - 1)
+            memory = 100 * (result["peak_memory_mb"]
+                    / base["peak_memory_mb"] - 1)
+            for metric, change, worse in [
+                    ("steps/s", speed, speed < -threshold),
+                    ("peak MB", memory, memory > threshold)]:
+                print("  {:>10} {:>16} {:>+14.1f} {:>12}".format(
+                    name, metric, change, "REGRESSION" if worse else ""))
+                regressed = regressed or worse
+    return regressed
+
+
+BENCHMARKS = {
+        "step_throughput": bench_step_throughput,
+        "arithmetic": bench_arithmetic,
+        "engines": bench_engines,
+        "load": bench_load,
+        "literals": bench_literals,
+        "cache": bench_cache,
+        "bytecode": bench_bytecode,
+        "text": bench_text,
+        "output": bench_output,
+        "input": bench_input,
+        "batch": bench_batch,
+        "fanout": bench_fanout,
+        "async": bench_async,
+        "fusion": bench_fusion,
+        "folding": bench_folding,
+        "dead_code": bench_dead_code,
+        "buffers": bench_buffers,
+        "workloads": bench_workloads,
+        }
+
+
+#
+#
+# MAIN
+#
+#
+
+
+if __name__ == "__main__":
+    description = "Benchmarks of the IPPcode22 interpret."
+    interpret_help = (
+            "Path to the interpret to benchmark (./interpret.py). Can be used "
+            + "multiple times to compare interprets (eg. an older version)")
+    save_baseline_help = (
+            "Save the results (of benchmarks having any, eg. workloads) of "
+            + "the first interpret to a JSON file")
+    baseline_help = (
+            "Compare the results with a JSON file saved by --save-baseline, "
+            + "exit with 1 if any of them is worse than the threshold")
+    threshold_help = (
+            "Change of steps per second or peak memory (in percents) "
+            + "considered a regression (10 by default)")
+    names_help = "Benchmarks to run (all if none provided): " + ", ".join(
+            BENCHMARKS)
+    argparser = argparse.ArgumentParser(description=description)
+    argparser.add_argument("--interpret", action="append", help=interpret_help)
+    argparser.add_argument("--save-baseline", action="store",
+            help=save_baseline_help)
+    argparser.add_argument("--baseline", action="store", help=baseline_help)
+    argparser.add_argument("--threshold", action="store", type=float,
+            default=10, help=threshold_help)
+    argparser.add_argument("names", nargs="*", help=names_help)
+    args = vars(argparser.parse_args())
+
+    for name in args["names"]:
+        if name not in BENCHMARKS:
+            sys.stderr.write("Unknown benchmark: \"" + name + "\"\n")
+            exit(1)
+
+    baseline = None
+    if args["baseline"] != None:
+        with open(args["baseline"]) as f:
+            baseline = json.load(f)
+
+    interprets = args["interpret"] or [
+            os.path.join(os.path.dirname(__file__), "interpret.py")]
+    regressed = False
+    for i, interpret in enumerate(interprets):
+        if len(interprets) > 1:
+            print("Interpret: " + interpret)
+        results = {}
+        for name in args["names"] or BENCHMARKS:
+            benchmark_results = BENCHMARKS[name](interpret)
+            if benchmark_results != None:
+                results[name] = benchmark_results
+
+        if baseline != None:
+            regressed = compare_baseline(results, baseline,
+                    args["threshold"]) or regressed
+        if args["save_baseline"] != None and i == 0:
+            with open(args["save_baseline"], "w") as f:
+                json.dump(results, f, indent=2)
+
+    if regressed:
+        exit(1)
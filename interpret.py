@@ -2,10 +2,24 @@
 # Author: Patrik Skaloš
 
 import re
+import glob
+import asyncio
+import io
+import json
+import time
+import traceback
+import multiprocessing
+import os
+import gc
+import pickle
+import mmap
+import struct
+import hashlib
 import argparse
 import xml.etree.ElementTree as ET
 import sys
 import operator
+import functools
 
 #
 #
@@ -14,28 +28,832 @@ import operator
 #
 
 
-# Print an error and exit if an exit code was provided
+# Exit because of an error (raise InterpretError) if an exit code was
+# provided, otherwise just print the error (warning)
 def err(code, *text):
-    for i in range(len(text)):
-        sys.stderr.write(text[i])
     if code != None:
-        sys.stderr.write(". Exiting\n")
-        exit(code)
-    else:
-        sys.stderr.write("\n")
+        raise InterpretError(code, "".join(text))
+    sys.stderr.write("".join(text) + "\n")
 
 
-# Print an error and the current location and exit if an exit code was provided
+# Exit because of an error of the instruction being executed (raise
+# InterpretError, the instruction is added to it by the program running it)
 def code_err(code, *text):
-    sys.stderr.write("Error at instruction + " + program.prev_instr.opcode 
-            + " with order " + str(program.prev_instr.order) + ": ")
-    for i in range(len(text)):
-        sys.stderr.write(text[i])
-    if code != None:
-        sys.stderr.write(". Exiting\n")
-        exit(code)
+    raise InterpretError(code, "".join(text))
+
+
+# Print the error which ended the interpretation (InterpretExit provided) to a
+# file (if it ended because of an error) and get the exit code
+def report_exit(e, file):
+    if isinstance(e, InterpretError):
+        file.write(str(e) + ". Exiting\n")
+    return e.code
+
+
+# Convert all escape sequences (a backslash and a decimal code) of a string
+# literal to the characters they represent in a single pass (the literal is
+# split to the text between the sequences and their codes). The literals
+# decoded can be kept in a dictionary by their texts (one for every program
+# loaded), so the same literals are decoded once and share one str
+def decode_escapes(text, literals=None):
+    if literals != None and text in literals:
+        return literals[text]
+    decoded = text
+    if "\\" in text:
+        parts = ESCAPE_REGEX.split(text)
+        parts[1::2] = map(chr, map(int, parts[1::2]))
+        decoded = "".join(parts)
+    if literals != None:
+        literals[text] = decoded
+    return decoded
+
+
+# Convert a value to its text representation (as printed by WRITE or DPRINT)
+def format_value(value):
+    if value is NIL:
+        return "nil"
+    elif isinstance(value, bool):
+        return "true" if value else "false"
+    else:
+        return str(value)
+
+
+# Compile the source code of a program transpiled to python (see Transpiler).
+# The code objects of the last few programs compiled are kept, so a program run
+# many times (eg. on many inputs by --inputs) is only compiled once
+@functools.lru_cache(maxsize=16)
+def compile_transpiled(source):
+    return compile(source, "<transpiled>", "exec")
+
+
+# Get an entry of a variable (a tuple of its data type and value) with its value
+# converted to a str if it is a StringBuffer
+def flat_entry(entry):
+    if entry[1].__class__ is StringBuffer:
+        return ("string", entry[1].flat())
+    return entry
+
+
+# Get the names of variables which can contain a StringBuffer: the ones CONCAT
+# appends to and SETCHAR changes (in any frame, as frames are moved from TF to
+# LF and back)
+def buffer_names(instructions):
+    names = set()
+    for instruction in instructions:
+        args = instruction.args
+        if instruction.static_error != None:
+            continue
+        if ((instruction.opcode == "CONCAT" and args[0].same_var(args[1]))
+                or instruction.opcode == "SETCHAR"):
+            names.add(args[0].name)
+    return names
+
+
+# Parse a line of input (as read by READ, None at EOF) to a value of the data
+# type provided, returns a tuple of the data type and value
+def parse_input(line, literal_type):
+    try:
+        # If there is no line (EOF):
+        if line == None:
+            raise Exception("Missing input")
+        # Parse the input
+        if literal_type == "int":
+            return ("int", int(line))
+        elif literal_type == "string":
+            return ("string", line)
+        elif literal_type == "bool":
+            return ("bool", line.upper() == "TRUE")
+        else:
+            raise Exception("Invalid type")
+    # If anything is wrong with the input, nil will be read
+    except:
+        return ("nil", NIL)
+
+
+# Write the profile of a program run by Program.run_profiled to a JSON file
+# and print tables of opcodes and instructions which took the most time to the
+# standard error output
+def write_profile(program, path):
+    program.output.flush()
+    counts, times = program.profile
+    instructions = []
+    opcodes = {}
+    for i, instruction in enumerate(program.instructions):
+        if counts[i] == 0:
+            continue
+        instructions.append({"order": instruction.order,
+            "opcode": instruction.opcode, "count": counts[i],
+            "time": times[i]})
+        stats = opcodes.setdefault(instruction.opcode,
+                {"opcode": instruction.opcode, "count": 0, "time": 0.0})
+        stats["count"] += counts[i]
+        stats["time"] += times[i]
+    instructions.sort(key=lambda x: x["time"], reverse=True)
+    opcodes = sorted(opcodes.values(), key=lambda x: x["time"], reverse=True)
+    total = sum(times)
+
+    try:
+        with open(path, "w") as profile_file:
+            json.dump({"steps": sum(counts), "time": total,
+                "opcodes": opcodes, "instructions": instructions},
+                profile_file, indent=2)
+    except OSError:
+        err(None, "Warning: cannot write the profile")
+
+    # Print at most 20 instructions (the JSON file contains all of them)
+    row = "{:>12} {:>12} {:>10} {:>12} {:>7}\n"
+    sys.stderr.write("Profile (" + str(sum(counts)) + " steps, "
+            + "{:.3f}".format(total) + " s):\n")
+    sys.stderr.write(row.format("opcode", "", "count", "time [s]", "%"))
+    for stats in opcodes:
+        sys.stderr.write(row.format(stats["opcode"], "", stats["count"],
+            "{:.6f}".format(stats["time"]),
+            "{:.1f}".format(100 * stats["time"] / (total or 1))))
+    sys.stderr.write(row.format("opcode", "order", "count", "time [s]", "%"))
+    for stats in instructions[: 20]:
+        sys.stderr.write(row.format(stats["opcode"], stats["order"],
+            stats["count"], "{:.6f}".format(stats["time"]),
+            "{:.1f}".format(100 * stats["time"] / (total or 1))))
+
+
+# Print how many sequences of instructions were fused to superinstructions (see
+# Superinstructions) and how many constants were folded and propagated (see
+# Folding) by the closure engine to the standard error output
+def write_fusions(program):
+    program.output.flush()
+    sys.stderr.write("Constants: " + str(program.folds.get("folded", 0))
+            + " operations folded, " + str(program.folds.get("propagated", 0))
+            + " operands propagated\n")
+    row = "{:>16} {:>10}\n"
+    sys.stderr.write("Fusions (" + str(sum(program.fusions.values()))
+            + " applied):\n")
+    sys.stderr.write(row.format("pattern", "count"))
+    for name, _ in FUSIONS:
+        sys.stderr.write(row.format(name, program.fusions.get(name, 0)))
+
+
+# Write the call stacks sampled by Program.run_sampled to a file in the
+# collapsed stack format (a line "main;label;...;OPCODE#order count" for every
+# different stack), which is accepted by flamegraph tools
+def write_samples(program, path):
+    program.output.flush()
+    try:
+        with open(path, "w") as samples_file:
+            for stack in sorted(program.samples):
+                samples_file.write(stack + " " + str(program.samples[stack])
+                        + "\n")
+    except OSError:
+        err(None, "Warning: cannot write the sampled call stacks")
+
+
+# Run a program using the engine provided (a name from ENGINES) while capturing
+# its standard output, standard error output and exit code, which are returned.
+# The optimization level is used by the closure engine
+def run_captured(engine, instructions, input_data, optimize=0):
+    output, errors = Output(io.StringIO()), io.StringIO()
+    code = 0
+    try:
+        program = Program(Input(io.BytesIO(input_data)), instructions,
+                output=output, error_file=errors, optimize=optimize)
+        program.run(ENGINES[engine])
+    except InterpretExit as e:
+        code = report_exit(e, errors)
+    finally:
+        output.flush()
+    return (output.file.getvalue(), errors.getvalue(), code)
+
+
+# Run a program using all engines and compare their outputs and exit codes. If
+# they are the same, act as if the program was run normally (writing to the
+# output provided), otherwise report the differences
+def run_differential(instructions, input_data, output, optimize=0):
+    results = {}
+    for engine in ENGINES:
+        results[engine] = run_captured(engine, instructions, input_data,
+                optimize)
+
+    reference = results["reference"]
+    differs = False
+    for engine in ENGINES:
+        for i, name in enumerate(["Standard output", "Error output", "Code"]):
+            if results[engine][i] != reference[i]:
+                err(None, name + " of engine " + engine + " differs from the "
+                        + "reference engine:")
+                err(None, "  reference: " + repr(reference[i]))
+                err(None, "  " + engine + ": " + repr(results[engine][i]))
+                differs = True
+
+    if differs:
+        err(99, "Engines produced different results")
+
+    output.write(reference[0])
+    output.flush()
+    sys.stderr.write(reference[1])
+    raise InterpretExit(reference[2])
+
+
+# Run the interpret as requested by its arguments (a dictionary, as parsed by
+# the argparser): open the files (the input and source are read from the
+# standard input and the output is written to the standard output unless files
+# are specified), load the program and run it
+def run_interpret(args):
+    files = []
+    try:
+        # Program input is read from the standard input unless a file is
+        # specified
+        input_file = sys.stdin.buffer
+        if args["input"] != None:
+            try:
+                input_file = open(args["input"], "rb")
+            except:
+                err(11, "Input file provided cannot be read")
+            files.append(input_file)
+
+        # XML input is read from the standard input unless a file is specified
+        # (or the program was already loaded and prepared, eg. by a fan-out)
+        xml_file = sys.stdin.buffer
+        if args["source"] != None and args.get("program") == None:
+            try:
+                xml_file = open(args["source"], "rb")
+            except:
+                err(11, "XML file provided cannot be read")
+            files.append(xml_file)
+
+        # Program output is written to the standard output unless a file is
+        # specified
+        output_file = sys.stdout
+        if args["output"] != None:
+            try:
+                output_file = open(args["output"], "w")
+            except:
+                err(12, "Output file provided cannot be written to")
+            files.append(output_file)
+        output = Output(output_file, args["output_buffer"])
+
+        # Get all instructions from the XML file
+        if args.get("program") != None:
+            instructions, labels = args["program"]
+        else:
+            instructions, labels = load_source(xml_file, args)
+
+        # Write the program in bytecode instead of running it if requested
+        if args["emit_bytecode"] != None:
+            if labels == None and instructions != []:
+                labels = Program(None, instructions).labels
+            write_bytecode(args["emit_bytecode"], instructions, labels or {})
+            return
+
+        # Run the program using all engines and compare the results
+        if args["engine"] == "diff":
+            run_differential(instructions, input_file.read(), output,
+                    args["optimize"])
+
+        # Initialize the program
+        program = Program(Input(input_file), instructions, labels, output,
+                optimize=args["optimize"])
+
+        # Write the program transpiled to python if requested
+        if args["dump_source"] != None:
+            try:
+                with open(args["dump_source"], "w") as dump_file:
+                    dump_file.write(Transpiler(program.instructions).source())
+            except OSError:
+                err(12, "Cannot write the transpiled source code")
+
+        # Write the control flow graph of the program if requested
+        if args["cfg_dump"] != None:
+            try:
+                with open(args["cfg_dump"], "w") as dump_file:
+                    dump_file.write(ControlFlow(program.instructions).dot())
+            except OSError:
+                err(12, "Cannot write the control flow graph")
+
+        # Run instructions until done (the output is flushed even if the
+        # program exits)
+        try:
+            if args["profile"] != None:
+                try:
+                    program.run(Program.run_profiled)
+                finally:
+                    write_profile(program, args["profile"])
+            elif args["sample"] != None:
+                try:
+                    program.run(Program.run_sampled, args["sample_interval"])
+                finally:
+                    write_samples(program, args["sample"])
+            elif args["fusion_report"]:
+                try:
+                    program.run(ENGINES[args["engine"]])
+                finally:
+                    write_fusions(program)
+            else:
+                program.run(ENGINES[args["engine"]])
+        finally:
+            output.flush()
+    finally:
+        for opened_file in files:
+            opened_file.close()
+
+
+# Run a job of a batch (a dictionary of arguments of the interpret, see
+# run_batch) in the same way as the interpret would run it, returns its error
+# output and exit code (its output is written to the output file of the job)
+def run_job(args):
+    stderr = sys.stderr
+    sys.stderr = io.StringIO()
+    code = 0
+    try:
+        run_interpret(args)
+    except InterpretExit as e:
+        code = report_exit(e, sys.stderr)
+    except Exception:
+        # An error of the interpret itself would end the whole batch
+        traceback.print_exc()
+        code = 1
+    finally:
+        result = (sys.stderr.getvalue(), code)
+        sys.stderr = stderr
+    return result
+
+
+# Run all jobs of a batch manifest (a file where every line contains paths to
+# the source, input and output files of a job) by a pool of processes. For
+# every job, a JSON object with the paths, its error output and exit code is
+# written to the standard output (in the order of the manifest)
+def run_batch(args):
+    try:
+        with open(args["batch"], "r") as manifest:
+            lines = manifest.read().splitlines()
+    except OSError:
+        err(11, "Batch manifest provided cannot be read")
+
+    jobs = []
+    for number, line in enumerate(lines, 1):
+        if line.strip() == "":
+            continue
+        paths = line.split()
+        if len(paths) != 3:
+            err(11, "Line " + str(number) + " of the batch manifest needs to "
+                    + "contain paths to the source, input and output files")
+        jobs.append(dict(args, batch=None, source=paths[0], input=paths[1],
+            output=paths[2]))
+
+    with multiprocessing.Pool(args["jobs"]) as pool:
+        for job, (stderr, code) in zip(jobs, pool.imap(run_job, jobs)):
+            sys.stdout.write(json.dumps({"source": job["source"],
+                "input": job["input"], "output": job["output"],
+                "stderr": stderr, "code": code}) + "\n")
+
+
+# Get the paths of all input files of a fan-out: files in a directory or files
+# matching a glob pattern (sorted by their names)
+def fanout_inputs(pattern):
+    if os.path.isdir(pattern):
+        paths = [os.path.join(pattern, name) for name in os.listdir(pattern)]
     else:
-        sys.stderr.write("\n")
+        paths = glob.glob(pattern)
+    paths = sorted(path for path in paths if os.path.isfile(path))
+    if paths == []:
+        err(11, "No input files found: " + pattern)
+    return paths
+
+
+# Prepare a worker of a fan-out, the arguments of the interpret (including the
+# program) are shared with the parent process as the worker is forked
+def init_fanout(args):
+    global fanout_args
+    fanout_args = args
+
+
+# Run the program of a fan-out on an input file (a tuple of paths to the input
+# and output file) in the same way as the interpret would run it, returns its
+# error output, exit code and time of the run
+def run_fanout_job(paths):
+    start = time.perf_counter()
+    stderr, code = run_job(dict(fanout_args, input=paths[0],
+        output=paths[1]))
+    return stderr, code, time.perf_counter() - start
+
+
+# Run the program on all input files of a fan-out (see fanout_inputs) by a pool
+# of processes. The program is loaded, checked and prepared only once, then
+# the workers are forked and share it (copy-on-write) while every one of them
+# runs the program with its own state. The output of every input file is
+# written to the output directory (named as the input file with ".out"). For
+# every input, a JSON object with the paths, its error output, exit code and
+# time of the run (in seconds) is written to the standard output
+def run_fanout(args):
+    inputs = fanout_inputs(args["inputs"])
+    try:
+        os.makedirs(args["output"], exist_ok=True)
+    except OSError:
+        err(12, "Output directory provided cannot be created")
+    jobs = [(path, os.path.join(args["output"], os.path.basename(path)
+        + ".out")) for path in inputs]
+
+    # Load and prepare the program (an empty program is left to the workers
+    # to exit with 0). XML input is read from the standard input unless a file
+    # is specified
+    xml_file = sys.stdin.buffer
+    if args["source"] != None:
+        try:
+            xml_file = open(args["source"], "rb")
+        except OSError:
+            err(11, "XML file provided cannot be read")
+    try:
+        instructions, labels = load_source(xml_file, args)
+    finally:
+        if xml_file != sys.stdin.buffer:
+            xml_file.close()
+    if labels == None and instructions != []:
+        labels = Program(None, instructions).labels
+
+    # Keep the garbage collector of the workers from touching (and so copying)
+    # the objects of the program
+    gc.freeze()
+    context = multiprocessing.get_context("fork")
+    with context.Pool(args["jobs"], init_fanout, (dict(args, inputs=None,
+            program=(instructions, labels)),)) as pool:
+        for (input_path, output_path), (stderr, code, elapsed) in zip(jobs,
+                pool.imap(run_fanout_job, jobs)):
+            sys.stdout.write(json.dumps({"input": input_path,
+                "output": output_path, "stderr": stderr, "code": code,
+                "time": round(elapsed, 6)}) + "\n")
+
+
+#
+#
+# Loading programs
+#
+#
+
+
+# Read a program in XML format from a (binary) file and get a list of its
+# instructions. The file is parsed, checked and converted to instructions in
+# a single pass and every instruction element is dropped once it is converted,
+# so the whole XML tree is never held in memory
+def load_xml(xml_file):
+    allowed = ["instruction", "arg1", "arg2", "arg3", "name", "description"]
+    instructions = []
+    xml_root = None
+    depth = 0
+
+    # Decoded string literals by their texts (see decode_escapes)
+    literals = {}
+
+    try:
+        for event, elem in ET.iterparse(xml_file, events=("start", "end")):
+            if event == "start":
+                depth += 1
+
+                # Check the root element and the language
+                if xml_root == None:
+                    xml_root = elem
+                    if elem.tag != "program":
+                        err(32, "Missing root element in the XML file")
+                    language = elem.attrib.get("language", "")
+                    if language.upper() != "IPPCODE22":
+                        err(32, "Unrecognized language in the XML file")
+                    continue
+
+                # Check for tags that are not allowed
+                if elem.tag not in allowed:
+                    err(32, "Invalid tag in the XML file: \"" + elem.tag + "\"")
+
+                # Order and opcode of an instruction needs to be specified
+                if (elem.tag == "instruction" and 
+                        ("order" not in elem.attrib
+                            or "opcode" not in elem.attrib)):
+                    err(32, "Received an instruction without opcode or order")
+
+                # Type of the argument needs to be specified
+                if (elem.tag in ["arg1", "arg2", "arg3"]
+                        and "type" not in elem.attrib):
+                    err(32, "Received an argument without type specified")
+
+            else:
+                depth -= 1
+
+                # Convert a whole instruction (a child of the root element)
+                if depth == 1 and elem.tag == "instruction":
+
+                    # Order must be a number above 0
+                    order = elem.attrib["order"]
+                    if LOAD_REGEXES["order"].match(order) == None:
+                        err(32, "Order of an instruction #n/a is not a number")
+                    if int(order) < 1:
+                        err(32, "Order of an instruction #" + order
+                                + " is lower than 1")
+
+                    # Parse the instruction by creating an object
+                    parsed_instr = Instruction(elem.attrib["opcode"],
+                            int(order))
+
+                    # Append it to our array
+                    instructions.append(parsed_instr)
+
+                    # Add all the arguments
+                    for xml_arg in elem:
+                        parsed_instr.add_arg(xml_arg, literals)
+                    parsed_instr.check_args()
+
+                # Drop the elements that are converted already
+                if depth == 1:
+                    xml_root.clear()
+
+    except ET.ParseError:
+        err(31, "The XML provided is invalid")
+
+    return instructions
+
+
+# Read a program in the IPPcode22 source code format from a (binary) file line
+# by line and get a list of its instructions, without converting it to XML.
+# The same rules as by parse.php are applied: the header (.IPPcode22) needs to
+# precede all instructions, comments (from "#") are ignored, opcodes are case
+# insensitive and every argument needs to match a regex of its kind (see
+# TEXT_REGEXES). Errors are reported with the same return codes (21 for the
+# header, 22 for an opcode and 23 for arguments)
+def load_text(source_file):
+    instructions = []
+    header = False
+
+    # Decoded string literals by their texts (see decode_escapes)
+    literals = {}
+    for line in source_file:
+        line = line.decode("utf-8", "replace").split("#", 1)[0]
+        words = [word for word in line.replace("\t", " ").rstrip("\n\r ")
+                .split(" ") if word != ""]
+        if words == []:
+            continue
+
+        # Check for the header (case insensitive)
+        if not header:
+            if len(words) != 1 or words[0].upper() != ".IPPCODE22":
+                err(21, "Wrong or no header was found in the provided code")
+            header = True
+            continue
+
+        # Check the opcode and the amount of arguments
+        opcode = words[0].upper()
+        if opcode not in INSTRUCTIONS:
+            err(22, "Unknown instruction: '" + opcode + "'")
+        kinds = INSTRUCTIONS[opcode]["types"]
+        if len(kinds) != len(words) - 1:
+            err(23, "Invalid amount of arguments (" + str(len(words) - 1)
+                    + " instead of " + str(len(kinds)) + ") for instruction: '"
+                    + opcode + "'")
+
+        # Parse the arguments by the regexes of their kinds (a symbol is a
+        # variable or a literal, which is split to its type and value)
+        instruction = Instruction(opcode, len(instructions) + 1)
+        for order, (kind, word) in enumerate(zip(kinds, words[1:]), 1):
+            if (kind in ["var", "symb"]
+                    and TEXT_REGEXES["var"].match(word) != None):
+                arg_type, val = "var", word
+            elif kind == "symb" and any(TEXT_REGEXES[literal].match(word)
+                    != None for literal in ["int", "bool", "string", "nil"]):
+                arg_type, val = word.split("@", 1)
+                if arg_type == "string":
+                    val = decode_escapes(val, literals)
+            elif (kind in ["label", "type"]
+                    and TEXT_REGEXES[kind].match(word) != None):
+                arg_type, val = kind, word
+            else:
+                err(23, "Bad argument: '" + word + "' for instruction: '"
+                        + opcode + "'")
+            instruction.args.append(Argument(order, arg_type, val))
+        instructions.append(instruction)
+
+    return instructions
+
+
+# Load a program from a XML (binary) file using a cache directory. Prepared
+# programs (instructions and labels as prepared by Program) are stored in the
+# directory by a hash of the XML file and the format version, so when the same
+# XML file is loaded again, it doesn't need to be parsed, checked, linked or
+# verified. The file is parsed by the loader provided (eg. load_text for
+# source code). Returns a tuple of the instructions and labels
+def load_cached(xml_file, cache_dir, loader=load_xml):
+
+    # Hash the XML file (read it to the memory if it can't be read again)
+    digest = hashlib.sha256(("IPPcode22 cache " + str(CACHE_VERSION) + " "
+        + loader.__name__).encode())
+    if not xml_file.seekable():
+        xml_file = io.BytesIO(xml_file.read())
+    for chunk in iter(lambda: xml_file.read(1 << 20), b""):
+        digest.update(chunk)
+    xml_file.seek(0)
+    cache_path = os.path.join(cache_dir, digest.hexdigest() + ".pickle")
+
+    # Use the cached program if possible (a cache file in an older format or
+    # an unreadable one is ignored). The garbage collector would only slow down
+    # creating the many objects of the program, which live until the end, so
+    # it is paused and the objects are then excluded from its collections
+    try:
+        gc.disable()
+        with open(cache_path, "rb") as cache_file:
+            version, instructions, labels = pickle.load(cache_file)
+        if version == CACHE_VERSION:
+            gc.freeze()
+            return instructions, labels
+    except Exception:
+        pass
+    finally:
+        gc.enable()
+
+    # Prepare the program and save it (through a temporary file, so another
+    # interpret never reads a partially written program)
+    program = Program(None, loader(xml_file))
+    data = (CACHE_VERSION, program.instructions, program.labels)
+    tmp_path = cache_path + "." + str(os.getpid()) + ".tmp"
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(tmp_path, "wb") as cache_file:
+            pickle.dump(data, cache_file, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except (OSError, pickle.PicklingError):
+        err(None, "Warning: cannot write to the cache directory")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return program.instructions, program.labels
+
+
+# Write a prepared program (instructions and labels as prepared by Program) to
+# a file in the bytecode format, which is the header (see BYTECODE_HEADER)
+# followed by these sections:
+#   string pool: offsets of the ends of all strings (4 bytes each) followed by
+#       the strings (UTF-8), referred to by their indices from 1 (0 is None)
+#   opcode table: strings of all opcodes used, referred to by their indices
+#   instructions: BYTECODE_INSTRUCTION records sorted by orders, every one
+#       containing its order, opcode, amount of arguments and the strings of
+#       the types and texts of three arguments (0 if there aren't as many)
+#   label table: BYTECODE_LABEL records (label name, index of its LABEL
+#       instruction)
+def write_bytecode(path, instructions, labels):
+    strings = {None: 0}
+    def string(text):
+        if text not in strings:
+            strings[text] = len(strings)
+        return strings[text]
+
+    opcodes = {}
+    records = []
+    for instruction in instructions:
+        if instruction.opcode not in opcodes:
+            opcodes[instruction.opcode] = len(opcodes)
+        refs = []
+        for arg in instruction.args:
+            refs += [string(arg.type), string(arg.val)]
+        refs += [0] * (6 - len(refs))
+        records.append(BYTECODE_INSTRUCTION.pack(instruction.order,
+            opcodes[instruction.opcode], len(instruction.args), *refs))
+    opcode_table = [string(opcode) for opcode in opcodes]
+    label_table = [BYTECODE_LABEL.pack(string(name), index)
+            for name, index in labels.items()]
+
+    encoded = [text.encode("utf-8", "surrogatepass")
+            for text in list(strings)[1:]]
+    ends = []
+    end = 0
+    for data in encoded:
+        end += len(data)
+        ends.append(end)
+
+    try:
+        with open(path, "wb") as bytecode_file:
+            bytecode_file.write(BYTECODE_HEADER.pack(BYTECODE_MAGIC,
+                BYTECODE_VERSION, len(encoded), len(opcode_table),
+                len(records), len(label_table)))
+            bytecode_file.write(struct.pack("<" + str(len(ends)) + "I",
+                *ends))
+            bytecode_file.write(b"".join(encoded))
+            bytecode_file.write(struct.pack("<" + str(len(opcode_table))
+                + "I", *opcode_table))
+            bytecode_file.write(b"".join(records))
+            bytecode_file.write(b"".join(label_table))
+    except OSError:
+        err(12, "Cannot write the bytecode")
+
+
+# Load a program in the bytecode format (see write_bytecode) from a (binary)
+# file. The file is mapped to the memory if possible (otherwise it is read),
+# so the records are read right from it through a memoryview without copying
+# it. Arguments which are the same (including their order) are shared by
+# the instructions. Returns a tuple of the instructions and labels, which are
+# already prepared (linked and verified)
+def load_bytecode(bytecode_file):
+    try:
+        data = mmap.mmap(bytecode_file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError, io.UnsupportedOperation):
+        data = bytecode_file.read()
+
+    # The objects of the program live until the end (see load_cached). The
+    # file is unmapped once it is read (nothing refers to it afterwards)
+    try:
+        gc.disable()
+        try:
+            with memoryview(data) as view:
+                instructions, labels = read_bytecode(view)
+        except (struct.error, IndexError, UnicodeDecodeError, ValueError):
+            err(31, "The bytecode provided is invalid")
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+        # Link and verify the instructions (they are already sorted and the
+        # labels are known)
+        for instruction in instructions:
+            instruction.verify()
+        if instructions != []:
+            Program(None, instructions, labels).link_labels()
+        gc.freeze()
+    finally:
+        gc.enable()
+    return instructions, labels
+
+
+# Read the instructions and labels of a program in the bytecode format (see
+# load_bytecode) from a memoryview
+def read_bytecode(view):
+    (magic, version, string_count, opcode_count, instruction_count,
+            label_count) = BYTECODE_HEADER.unpack_from(view, 0)
+    if magic != BYTECODE_MAGIC or version != BYTECODE_VERSION:
+        raise ValueError("Not a bytecode of a supported version")
+    offset = BYTECODE_HEADER.size
+
+    # String pool
+    ends = struct.unpack_from("<" + str(string_count) + "I", view, offset)
+    offset += 4 * string_count
+    strings = [None]
+    start = 0
+    for end in ends:
+        if end < start:
+            raise ValueError("Invalid string pool")
+        strings.append(str(view[offset + start : offset + end], "utf-8",
+            "surrogatepass"))
+        start = end
+    offset += start
+
+    # Opcode table
+    opcodes = [strings[index] for index in struct.unpack_from(
+        "<" + str(opcode_count) + "I", view, offset)]
+    for opcode in opcodes:
+        if opcode not in INSTRUCTIONS:
+            raise ValueError("Invalid opcode")
+    offset += 4 * opcode_count
+
+    # Instructions
+    end = offset + BYTECODE_INSTRUCTION.size * instruction_count
+    instructions = []
+    arguments = {}
+    previous = 0
+    for record in BYTECODE_INSTRUCTION.iter_unpack(view[offset : end]):
+        order, opcode, count = record[: 3]
+        if order <= previous or count > 3:
+            raise ValueError("Invalid instruction")
+        previous = order
+        instruction = Instruction(opcodes[opcode], order)
+        for i in range(count):
+            key = (i, record[3 + 2 * i], record[4 + 2 * i])
+            arg = arguments.get(key)
+            if arg == None:
+                arg = Argument(i + 1, strings[key[1]], strings[key[2]])
+                arguments[key] = arg
+            instruction.args.append(arg)
+        instruction.check_args()
+        instructions.append(instruction)
+    offset = end
+
+    # Label table
+    end = offset + BYTECODE_LABEL.size * label_count
+    labels = {}
+    for name, index in BYTECODE_LABEL.iter_unpack(view[offset : end]):
+        if (index >= instruction_count
+                or instructions[index].opcode != "LABEL"
+                or instructions[index].args[0].val != strings[name]):
+            raise ValueError("Invalid label")
+        labels[strings[name]] = index
+    if end != len(view):
+        raise ValueError("Invalid size")
+    return instructions, labels
+
+
+# Load the program from the source file (binary) as requested by the arguments
+# of the interpret: from bytecode if the source is a .ippc file, from source
+# code if it is a .IPPcode22 file (case insensitive), otherwise from XML (using
+# the cache directory if specified). Returns a tuple of the instructions and
+# labels (None if the instructions aren't prepared yet)
+def load_source(source_file, args):
+    source = args["source"] or ""
+    if source.endswith(".ippc"):
+        return load_bytecode(source_file)
+    loader = load_xml
+    if source.lower().endswith(".ippcode22"):
+        loader = load_text
+    if args["cache_dir"] != None:
+        return load_cached(source_file, args["cache_dir"], loader)
+    return loader(source_file), None
 
 
 #
@@ -45,15 +863,342 @@ def code_err(code, *text):
 #
 
 
+# An exception ending the interpretation with an exit code. It is raised
+# instead of exiting, so the interpretation can also be run eg. by a worker of
+# a batch or by an Interpreter (the interpret exits when it catches it)
+class InterpretExit(Exception):
+    def __init__(self, code):
+        super().__init__("Interpretation ended with the exit code "
+                + str(code))
+        self.code = code
+
+
+# An exception ending the interpretation because of an error, containing its
+# exit code, message and the opcode and order of the instruction where it
+# occurred (None if it didn't occur when running an instruction)
+class InterpretError(InterpretExit):
+    def __init__(self, code, message, opcode=None, order=None):
+        super().__init__(code)
+        self.message = message
+        self.opcode = opcode
+        self.order = order
+
+
+    def __str__(self):
+        if self.order == None:
+            return self.message
+        return ("Error at instruction + " + self.opcode + " with order "
+                + str(self.order) + ": " + self.message)
+
+
+# The nil data type, having only one value - NIL
+class Nil:
+    def __repr__(self):
+        return "nil"
+
+
+    # Unpickle as the same object
+    def __reduce__(self):
+        return "NIL"
+
+
+# A string value which can be changed in place. It is stored in a variable
+# instead of a str by CONCAT appending to the same variable and by SETCHAR, so
+# building a string part by part or changing its characters doesn't copy the
+# whole string every time. The parts appended are collected in a list until a
+# character is changed, then the string is kept as a list of its characters. A
+# buffer is only ever stored in one variable: reading the value of the
+# variable gets a str (see flat_entry), which is joined once and kept until the
+# buffer changes, so copies of the value (eg. by MOVE or PUSHS) never change
+class StringBuffer:
+    def __init__(self, string):
+        self.parts = [string]
+        self.chars = None
+        self.length = len(string)
+        self.string = string
+
+
+    def __len__(self):
+        return self.length
+
+
+    # Shown the same way as a str (eg. by BREAK)
+    def __repr__(self):
+        return repr(self.flat())
+
+
+    # Append a string
+    def append(self, string):
+        if self.chars != None:
+            self.chars.extend(string)
+        else:
+            self.parts.append(string)
+        self.length += len(string)
+        self.string = None
+
+
+    # Replace the character at the index provided (which needs to be valid)
+    def setchar(self, index, char):
+        if self.chars == None:
+            self.chars = list(self.flat())
+            self.parts = None
+        self.chars[index] = char
+        self.string = None
+
+
+    # Get the string as a str
+    def flat(self):
+        if self.string == None:
+            if self.chars != None:
+                self.string = "".join(self.chars)
+            else:
+                self.string = "".join(self.parts)
+                self.parts = [self.string]
+        return self.string
+
+
+# An output of the interpreted program (written by WRITE). The text written is
+# collected and written to the file at once when there is more of it than the
+# size of the buffer (in characters) and whenever the output is flushed, which
+# needs to be done before exiting and before writing to the standard error
+# output (so the outputs stay in order)
+class Output:
+    def __init__(self, file, buffer_size=1 << 20):
+        self.file = file
+        self.buffer_size = buffer_size
+        self.parts = []
+        self.size = 0
+
+
+    # Write a text to the output
+    def write(self, text):
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size > self.buffer_size:
+            self.flush()
+
+
+    # Write all text collected to the file
+    def flush(self):
+        if self.parts:
+            self.file.write("".join(self.parts))
+            self.parts = []
+            self.size = 0
+        self.file.flush()
+
+
+# An input of the interpreted program (read by READ) from a binary file. The
+# file is read in large chunks which are split to lines at once, so reading a
+# line is mostly just taking the next one from a list. Only the data available
+# is read (read1), so interactive input is not waited for. Files which are not
+# buffered (eg. a raw FileIO or any object with just a read method) are read
+# by read, which doesn't wait for more data than available either. Newlines
+# are handled like in files opened in text mode ("\r\n" and "\r" end lines
+# too)
+class Input:
+    def __init__(self, file, chunk_size=1 << 20):
+        self.file = file
+        self.read = getattr(file, "read1", None) or file.read
+        self.chunk_size = chunk_size
+        self.lines = []
+        self.index = 0
+        self.pending = b""
+        self.eof = False
+
+
+    # Read the next line (without the newline character), None at EOF
+    def readline(self):
+        if self.index == len(self.lines) and not self.fill():
+            return None
+        line = self.lines[self.index]
+        self.index += 1
+        return line
+
+
+    # Read the file until there are some more lines or EOF, returns whether
+    # there are any lines to be read
+    def fill(self):
+        self.lines = []
+        self.index = 0
+        while self.lines == [] and not self.eof:
+            self.feed(self.read(self.chunk_size))
+        return self.lines != []
+
+
+    # Split a chunk of data read from the file (b"" at EOF) to lines
+    def feed(self, chunk):
+        data = self.pending + chunk
+        held = b""
+        if chunk == b"":
+            self.eof = True
+        elif data[-1:] == b"\r":
+            # "\r\n" might be split between chunks
+            data, held = data[: -1], b"\r"
+        if b"\r" in data:
+            data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+
+        # The last line doesn't need to end with a newline
+        end = data.rfind(b"\n")
+        if self.eof and data != b"" and end != len(data) - 1:
+            end = len(data)
+        if end == -1:
+            self.pending = data + held
+        else:
+            text = data[: end].decode("utf-8", "replace")
+            self.lines = text.split("\n")
+            self.pending = data[end + 1 :] + held
+
+
+# An input of a program run as a coroutine (see Program.run_async), read from an
+# asyncio.StreamReader (or any object with a coroutine read(size)). Lines are
+# read by READ the same way as from Input, but only from the lines already
+# read, the program waits for more of them (fill_async) whenever it's not ready
+class AsyncInput(Input):
+
+    # Whether a line can be read without waiting for the reader
+    def ready(self):
+        return self.index < len(self.lines) or self.eof
+
+
+    # Never read from the reader synchronously (the input is ready, so there
+    # are no more lines when this is called)
+    def fill(self):
+        return False
+
+
+    # Read from the reader until there are some more lines or EOF
+    async def fill_async(self):
+        self.lines = []
+        self.index = 0
+        while self.lines == [] and not self.eof:
+            self.feed(await self.file.read(self.chunk_size))
+
+
+# An output of a program run as a coroutine (see Program.run_async), written to
+# an asyncio.StreamWriter (or any object with methods write(bytes) and a
+# coroutine drain()). The text collected is encoded and written to the writer
+# when flushed and the program waits for the writer (drain) regularly
+class AsyncOutput(Output):
+
+    # Write all text collected to the writer
+    def flush(self):
+        if self.parts:
+            self.file.write("".join(self.parts).encode("utf-8"))
+            self.parts = []
+            self.size = 0
+
+
+    # Write all text collected and wait until the writer accepts more
+    async def drain(self):
+        self.flush()
+        await self.file.drain()
+
+
+# An interpreter of a program in XML format (bytes) for use by other python
+# programs, eg. Interpreter(xml_bytes, input_stream, output_stream).run(). The
+# program is loaded and prepared once and can then be run any number of times
+# (also concurrently), every run having its own state. The input stream is
+# binary and the output and error streams are text, the standard ones by
+# default (no input by default). Errors are raised as InterpretError (with
+# their exit code, message, opcode and order), nothing is written about them
+# and the interpreter never exits. The optimization level is used by the
+# closure engine (see Program.compile_closures)
+class Interpreter:
+    def __init__(self, xml_bytes, input_stream=None, output_stream=None,
+            error_stream=None, engine="reference", optimize=0):
+        if engine not in ENGINES:
+            raise ValueError("Unknown engine: " + str(engine))
+        self.input_stream = input_stream
+        self.output_stream = output_stream
+        self.error_stream = error_stream
+        self.engine = engine
+        self.optimize = optimize
+        self.instructions = load_xml(io.BytesIO(xml_bytes))
+        self.labels = None
+        if self.instructions != []:
+            self.labels = Program(None, self.instructions).labels
+
+        # The transpiled engine runs the program transpiled and compiled once
+        self.transpiled = None
+        if engine == "transpiled" and self.instructions != []:
+            self.transpiled = compile_transpiled(
+                    Transpiler(self.instructions).source())
+
+
+    # Run the program, returns its exit code (0 unless it used EXIT). The input
+    # stream provided can only be read by one run
+    def run(self):
+        input_stream = self.input_stream
+        if input_stream == None:
+            input_stream = io.BytesIO(b"")
+        output = Output(self.output_stream if self.output_stream != None
+                else sys.stdout)
+        try:
+            program = Program(Input(input_stream), self.instructions,
+                    self.labels, output, self.error_stream, self.optimize)
+            program.transpiled = self.transpiled
+            program.run(ENGINES[self.engine])
+        except InterpretError:
+            raise
+        except InterpretExit as e:
+            return e.code
+        finally:
+            output.flush()
+        return 0
+
+
+    # Run the program as a coroutine reading its input from an async reader and
+    # writing its output to an async writer (see AsyncInput and AsyncOutput),
+    # returns its exit code the same way as run. The program is run by the
+    # closure engine and yields to the event loop after every slice_size steps
+    # and whenever a READ waits for input (the engine of the interpreter is
+    # ignored), so many programs can run concurrently in one event loop
+    async def run_async(self, reader, writer, slice_size=1000):
+        output = AsyncOutput(writer)
+        try:
+            program = Program(AsyncInput(reader), self.instructions,
+                    self.labels, output, self.error_stream, self.optimize)
+            await program.run_async(slice_size)
+        except InterpretError:
+            raise
+        except InterpretExit as e:
+            return e.code
+        finally:
+            await output.drain()
+        return 0
+
+
 # A single object containing all information about the interpretation
 class Program:
-    def __init__(self, input_file, instructions):
-        self.input_file = input_file
 
-        # Get instructions and sort them based on their orders
+    # The instructions are sorted, checked, linked and verified, unless labels
+    # are provided (the instructions were already prepared by a Program before,
+    # eg. when loaded from a cache). The program writes to the output (Output)
+    # and error output (text file) provided, or the standard ones. The
+    # optimization level is used by the closure engine (see compile_closures)
+    def __init__(self, input_file, instructions, labels=None, output=None,
+            error_file=None, optimize=0):
+        self.input_file = input_file
         self.instructions = instructions
-        self.instructions.sort(key=lambda x: x.order)
-        self.prev_instr = None
+        self.output = output if output != None else Output(sys.stdout)
+        self.error_file = error_file if error_file != None else sys.stderr
+        self.optimize = optimize
+
+        # Names of variables which can contain a StringBuffer (see
+        # compile_closures)
+        self.buffer_names = set()
+
+        # Code object of the instructions transpiled to python (see
+        # transpile), can be set to one compiled before (eg. by Interpreter)
+        self.transpiled = None
+
+        # Amounts of folded operations and propagated operands (see Folding)
+        # and of fused superinstructions by their patterns
+        self.folds = {}
+        self.fusions = {}
+
+        # Program counter - index of the instruction being executed
+        self.pc = 0
 
         # A symtable containing all frames
         self.symtab = SymTab()
@@ -63,7 +1208,19 @@ class Program:
 
         # Check whether we have some instructions in the first place...
         if self.instructions == []:
-            exit(0)
+            raise InterpretExit(0)
+
+        if labels != None:
+            self.labels = labels
+        else:
+            self.prepare()
+
+
+    # Sort, check, link and verify the instructions and remove dead code
+    def prepare(self):
+
+        # Sort the instructions based on their orders
+        self.instructions.sort(key=lambda x: x.order)
 
         # Check for duplicit orders of instructions in the XML file
         for i in range(len(self.instructions) - 1):
@@ -72,44 +1229,286 @@ class Program:
                         + str(self.instructions[i].order))
 
         # Extract labels
-        self.labels = {}
+        self.extract_labels()
+
+        # Bind label arguments to indices of the instructions they point to
+        self.link_labels()
+
+        # Check the static properties of all instructions
         for instruction in self.instructions:
+            instruction.verify()
+
+        # Remove the code which can never be executed
+        self.eliminate_dead_code()
+
+
+    # Get the indices of all labels by their names
+    def extract_labels(self):
+        self.labels = {}
+        for index, instruction in enumerate(self.instructions):
             if instruction.opcode == "LABEL":
-                label_name = instruction.args[0].symb_val()
+                label_name = instruction.args[0].val
 
                 # Make sure a label with that name doesn't already exist
                 if label_name in self.labels:
                     err(52, "Label name \"" + label_name + "\" used twice")
 
-                # Create the new label
-                self.labels[label_name] = instruction.order
+                # Create the new label (pointing to its index)
+                self.labels[label_name] = index
+
+
+    # Resolve all label arguments (of jumps and calls) to indices of their
+    # target instructions so the label names don't need to be looked up when
+    # jumping. A missing label is reported right away
+    def link_labels(self):
+        for instruction in self.instructions:
+            requirements = INSTRUCTIONS[instruction.opcode]["requirements"]
+            for i in range(len(instruction.args)):
+                arg = instruction.args[i]
+
+                # Only labels that are required to exist (not LABEL itself)
+                if arg.type != "label" or requirements[i] == "none":
+                    continue
+
+                if not arg.val in self.labels:
+                    err(52, "Label " + arg.val + " used by instruction #"
+                            + str(instruction.order) + " does not exist")
+                arg.target = self.labels[arg.val]
+
+
+    # Remove the instructions of blocks which can't be reached (see
+    # ControlFlow) and labels which are not targeted by any jump or call
+    # (labels are only removed once all of them were checked, so errors of
+    # labels are reported the same way). The list of instructions is changed
+    # in place and the remaining labels are linked again
+    def eliminate_dead_code(self):
+        instructions = ControlFlow(self.instructions).reachable_instructions()
+        targeted = set()
+        for instruction in instructions:
+            requirements = INSTRUCTIONS[instruction.opcode]["requirements"]
+            for i in range(len(instruction.args)):
+                if (instruction.args[i].type == "label"
+                        and requirements[i] != "none"):
+                    targeted.add(instruction.args[i].val)
+        instructions = [instruction for instruction in instructions
+                if instruction.opcode != "LABEL"
+                or instruction.static_error != None
+                or instruction.args[0].val in targeted]
+
+        # A program of labels only is kept as it is (it does nothing anyway)
+        if 0 < len(instructions) < len(self.instructions):
+            self.instructions[:] = instructions
+            self.extract_labels()
+            self.link_labels()
+
+
+    # Run the program by a method running its instructions (eg. from ENGINES)
+    # with the arguments provided and get its result. The instruction being
+    # executed (self.pc) is added to errors raised by instructions
+    def run(self, run_function, *args):
+        try:
+            return run_function(self, *args)
+        except InterpretError as e:
+            if e.order == None:
+                instruction = self.instructions[self.pc]
+                e.opcode, e.order = instruction.opcode, instruction.order
+            raise
 
 
-    # Run all instructions from the sorted instructions array in a loop
+    # Run all instructions from the sorted instructions array in a loop. The
+    # program counter is incremented after every instruction, so jumps only
+    # need to set it to the index of the instruction to continue after
     def run_all(self):
-        while True:
-            if self.prev_instr == None:
-                self.prev_instr = instructions[0]
-            elif instructions.index(self.prev_instr) + 1 < len(instructions):
-                prev_index = instructions.index(self.prev_instr)
-                self.prev_instr = instructions[prev_index + 1]
+        instructions = self.instructions
+        count = len(instructions)
+        self.pc = 0
+        while self.pc < count:
+            instructions[self.pc].run(self)
+            self.pc += 1
+
+
+    # Run all instructions the same way as run_all while measuring how many
+    # times every instruction is executed and the time it takes (stored as a
+    # tuple of two lists by indices of the instructions in self.profile, even
+    # if the program exits)
+    def run_profiled(self):
+        instructions = self.instructions
+        count = len(instructions)
+        counts = [0] * count
+        times = [0.0] * count
+        clock = time.perf_counter
+        self.profile = (counts, times)
+        self.pc = 0
+        while self.pc < count:
+            pc = self.pc
+            start = clock()
+            try:
+                instructions[pc].run(self)
+            finally:
+                times[pc] += clock() - start
+                counts[pc] += 1
+            self.pc += 1
+
+
+    # Run all instructions the same way as run_all while sampling the call
+    # stack before every interval-th step (see sample)
+    def run_sampled(self, interval):
+        instructions = self.instructions
+        count = len(instructions)
+        countdown = interval
+        self.samples = {}
+        self.pc = 0
+        while self.pc < count:
+            countdown -= 1
+            if countdown == 0:
+                countdown = interval
+                self.sample()
+            instructions[self.pc].run(self)
+            self.pc += 1
+
+
+    # Count the current call stack (labels called by the instructions in the
+    # return stack followed by the current instruction) in self.samples
+    def sample(self):
+        stack = ["main"]
+        for index in self.return_stack:
+            stack.append(self.instructions[index].args[0].val)
+        instruction = self.instructions[self.pc]
+        stack.append(instruction.opcode + "#" + str(instruction.order))
+        stack = ";".join(stack)
+        self.samples[stack] = self.samples.get(stack, 0) + 1
+
+
+    # Run all instructions compiled to closures (see Closures). Every closure
+    # returns the index of the instruction to be executed next
+    def run_closures(self):
+        code = self.compile_closures()
+        count = len(code)
+        pc = 0
+        while pc < count:
+            self.pc = pc
+            pc = code[pc]()
+
+
+    # Run all instructions compiled to closures as a coroutine (see
+    # Interpreter.run_async). The closures are run by slices of at most
+    # slice_size steps (see run_slice) and the program yields to the event loop
+    # between them, waiting for the output to be drained and for the input
+    # only when the next instruction is a READ which is not ready to read a
+    # line (so everything written before it is flushed first and a program
+    # which never reads never waits). The input and output need to be an
+    # AsyncInput and AsyncOutput
+    async def run_async(self, slice_size):
+        code = self.compile_closures()
+        reads = [instruction.opcode == "READ"
+                for instruction in self.instructions]
+        pc = 0
+        while pc < len(code):
+            if reads[pc] and not self.input_file.ready():
+                await self.input_file.fill_async()
+            await asyncio.sleep(0)
+            pc = self.run(Program.run_slice, code, reads, pc, slice_size)
+            await self.output.drain()
+
+
+    # Run at most `steps` closures from the index provided, stopping before a
+    # READ if the input is not ready. Returns the index of the next instruction
+    def run_slice(self, code, reads, pc, steps):
+        count = len(code)
+        ready = self.input_file.ready
+        while pc < count and steps > 0:
+            if reads[pc] and not ready():
+                break
+            self.pc = pc
+            pc = code[pc]()
+            steps -= 1
+        return pc
+
+
+    # Compile all instructions to closures (instructions containing a static
+    # error are run by Instruction.run so the error is reported the same way).
+    # With the optimization level 1, constants are folded and propagated (see
+    # Folding) and sequences of instructions are fused to superinstructions
+    # (see Superinstructions)
+    def compile_closures(self):
+        instructions = self.instructions
+        if self.optimize >= 1:
+            instructions, self.folds = Folding.fold(self)
+        self.buffer_names = buffer_names(instructions)
+        code = []
+        for index, instruction in enumerate(instructions):
+            if instruction.static_error != None:
+                compile_function = Closures.c_generic
             else:
-                return
-            self.prev_instr.run()
+                compile_function = INSTRUCTIONS[instruction.opcode]["closure"]
+            code.append(compile_function(self, instruction, index))
+        if self.optimize >= 1:
+            self.fusions = Superinstructions.fuse(self, instructions, code)
+        return code
+
+
+    # Run all instructions transpiled to python (see Transpiler). Every block
+    # returns the index of the instruction to be executed next
+    def run_transpiled(self):
+        blocks = self.transpile()
+        count = len(blocks)
+        pc = 0
+        while pc < count:
+            pc = blocks[pc]()
+
+
+    # Transpile the instructions to python and get a list of functions of all
+    # blocks (by indices of their first instructions)
+    def transpile(self):
+        if self.transpiled == None:
+            self.transpiled = compile_transpiled(
+                    Transpiler(self.instructions).source())
+
+        namespace = {
+                "P": self,
+                "S": self.symtab,
+                "GF": self.symtab.gf,
+                "R": self.return_stack,
+                "D": self.data_stack,
+                "I": self.instructions,
+                "E": self.error_at,
+                "InterpretExit": InterpretExit,
+                "W": self.output.write,
+                "RL": self.input_file.readline,
+                "parse_input": parse_input,
+                "NIL": NIL,
+                "format_value": format_value,
+                "B": StringBuffer,
+                "F": flat_entry,
+                }
+        exec(self.transpiled, namespace)
 
+        blocks = [None] * len(self.instructions)
+        for index, function in namespace["BLOCKS"].items():
+            blocks[index] = function
+        return blocks
 
-    # Jump to an instruction following the one provided
-    def jump_after(self, instruction):
-        self.prev_instr = instruction
 
+    # Report an error at the instruction with the index provided
+    def error_at(self, index, code, text):
+        self.pc = index
+        code_err(code, text)
+
+
+    # Print a debugging message along with the instruction being executed to
+    # the error output (after flushing the output, so they stay in order)
+    def debug(self, *text):
+        self.output.flush()
+        instruction = self.instructions[self.pc]
+        self.error_file.write("Error at instruction + " + instruction.opcode
+                + " with order " + str(instruction.order) + ": "
+                + "".join(text) + "\n")
+
+
+    # Jump to an instruction following the one with the index provided
+    def jump_after(self, index):
+        self.pc = index
 
-    # Jump to (after) a label with the name provided
-    def jump_to_label(self, label_name):
-        order = self.labels[label_name]
-        for instruction in instructions:
-            if instruction.order == order:
-                self.prev_instr = instruction
-                return
 
 
 # A symbol table for the interpretation (containing global, temporary and local
@@ -123,16 +1522,9 @@ class SymTab:
 
     # Returns a frame where the variable provided should be or is defined
     def get_frame(self, var):
-        if isinstance(var, str):
-            # If we got a literal
-            frame = var.split("@", 1)[0]
-        else:
-            # If we got a variable
-            frame = var.val.split("@", 1)[0]
-
-        if frame == "GF":
+        if var.frame == "GF":
             return self.gf
-        elif frame == "TF":
+        elif var.frame == "TF":
             if self.tf == None:
                 code_err(55, "Trying to use non-existant temporary frame")
             return self.tf
@@ -142,70 +1534,62 @@ class SymTab:
             return self.lfs[-1]
 
 
-    # Get the name of the variable
-    def get_name(self, var):
-        if isinstance(var, str):
-            # If we got a literal
-            return var.split("@", 1)[-1]
-        else:
-            # If we got a variable
-            return var.val.split("@", 1)[-1]
-
-
-    # Declare a variable (eg. using DEFVAR)
+    # Declare a variable (eg. using DEFVAR). Every variable is stored in its
+    # frame as a tuple of its data type and value, which are None until the
+    # variable is defined
     def declare(self, var):
-        name = self.get_name(var)
         frame = self.get_frame(var)
-        if name in frame:
-            code_err(52, "Redeclaration of variable " + name)
-        frame[name] = {
-                "declared": True,
-                "defined": False,
-                "type": None,
-                "val": None
-                }
+        if var.name in frame:
+            code_err(52, "Redeclaration of variable " + var.name)
+        frame[var.name] = (None, None)
 
 
     # Check whether a variable is declared
     def declared(self, var):
-        name = self.get_name(var)
-        frame = self.get_frame(var)
-        if name in frame and frame[name]["declared"] == True:
-            return True
-        else:
-            return False
+        return var.name in self.get_frame(var)
 
 
     # Define a variable (assign a value)
     def define(self, var, literal_type, literal):
-        name = self.get_name(var)
-        frame = self.get_frame(var)
-        frame[name] = {
-                "declared": True,
-                "defined": True,
-                "type": literal_type,
-                "val": literal
-                }
+        self.get_frame(var)[var.name] = (literal_type, literal)
 
 
     # Check whether a variable is defined
     def defined(self, var):
-        name = self.get_name(var)
-        frame = self.get_frame(var)
-        if name in frame and frame[name]["defined"] == True:
-            return True
-        else:
-            return False
+        return self.get(var) != None
 
 
-    # Return a variable (object)
+    # Return a tuple of the data type and value of a variable using a single
+    # lookup, or None if the variable is not defined (the value can be a
+    # StringBuffer)
     def get(self, var):
-        if self.defined(var):
-            frame = self.get_frame(var)
-            name = self.get_name(var)
-            return frame[name]
-        else:
+        entry = self.get_frame(var).get(var.name)
+        if entry == None or entry[0] == None:
             return None
+        return entry
+
+
+    # Append a string to the string value of a variable, which is kept in a
+    # StringBuffer
+    def append(self, var, string):
+        self.buffer(var).append(string)
+
+
+    # Replace a character of the string value of a variable (at a valid index),
+    # which is kept in a StringBuffer
+    def setchar(self, var, index, char):
+        self.buffer(var).setchar(index, char)
+
+
+    # Get the string value of a variable as a StringBuffer (a str is replaced
+    # by a new buffer)
+    def buffer(self, var):
+        frame = self.get_frame(var)
+        value = frame[var.name][1]
+        if value.__class__ is not StringBuffer:
+            value = StringBuffer(value)
+            frame[var.name] = ("string", value)
+        return value
 
 
 # Class defining an instruction, consisting of:
@@ -215,26 +1599,46 @@ class SymTab:
 class Instruction:
     def __init__(self, opcode, order):
 
-        # Order must be a number
-        if re.search("^\d+$", order) == None:
-            err(32, "Order of an instruction #n/a is not a number")
-
-        # Order must be above 0
-        if int(order) < 1:
-            err(32, "Order of an instruction #" + order + " is lower than 1")
-
         # Check for invalid opcode
         if not opcode.upper() in INSTRUCTIONS:
             err(32, "Invalid opcode: \"" + opcode + "\"")
 
-        self.order = int(order)
+        self.order = order
         self.opcode = opcode.upper()
         self.args = []
 
 
-    # Add an argument
-    def add_arg(self, arg):
-        self.args.append(Argument(arg))
+    # Functions of instructions are not pickled (eg. when cached), they are
+    # looked up again when unpickling
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("function", None)
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.function = INSTRUCTIONS[self.opcode]["function"]
+
+
+    # Add an argument from its XML element (string literals are decoded using
+    # the dictionary of literals of the program provided, see decode_escapes)
+    def add_arg(self, arg_xml, literals=None):
+
+        # Argument tag can only be "arg1", "arg2" or "arg3"
+        if LOAD_REGEXES["arg"].match(arg_xml.tag) == None:
+            err(32, "Received an argument with invalid tag")
+
+        arg_type = arg_xml.attrib["type"]
+        val = arg_xml.text
+        if arg_type == "string":
+
+            # If it is an empty string, val will be "None"
+            if val == None:
+                val = ""
+            val = decode_escapes(val, literals)
+
+        self.args.append(Argument(int(arg_xml.tag[-1]), arg_type, val))
         self.args.sort(key=lambda x: x.order)
 
 
@@ -251,37 +1655,26 @@ class Instruction:
             err(53, "Wrong arguments amount of instruction #" + str(self.order))
 
 
-    # Run the instruction
-    def run(self):
+    # Check everything about the arguments that can't change between runs
+    # (argument types and data types of literals) and prepare a list of checks
+    # that need to be done every time the instruction is executed. A static
+    # error is only reported when the instruction is executed (after checking
+    # the variables), the same way as if it was detected at runtime
+    def verify(self):
+        info = INSTRUCTIONS[self.opcode]
+        self.function = info["function"]
+        self.static_error = None
 
-        # Check if arguments are defined (not just declared)
+        # Variables that need to be declared or defined when executing
+        self.var_checks = []
         for i in range(len(self.args)):
-            req = INSTRUCTIONS[self.opcode]["requirements"][i]
-
-            # Skip if there's no requirement
-            if req not in ["declared", "defined"]:
-                continue
-
-            # If it is a label, check the existance
-            if self.args[i].type == "label":
-                name = self.args[i].val
-                if not name in program.labels:
-                    code_err(52, "Label " + name + " does not exist")
-
-            # If the argument is a variable, check the symbol table
-            elif self.args[i].type == "var":
-                var = self.args[i].val
-                if req == "declared" and not program.symtab.declared(var):
-                    code_err(54, "Variable " + var + " not declared")
-                elif req == "defined":
-                    if not program.symtab.declared(var):
-                        code_err(54, "Variable " + var + " not declared")
-                    if not program.symtab.defined(var):
-                        code_err(56, "Variable " + var + " not defined")
+            req = info["requirements"][i]
+            if self.args[i].type == "var" and req in ["declared", "defined"]:
+                self.var_checks.append((self.args[i], req))
 
         # Check argument types
         for i in range(len(self.args)):
-            req_type = INSTRUCTIONS[self.opcode]["types"][i]
+            req_type = info["types"][i]
             got_type = self.args[i].type
 
             # Skip if we don't care about the type
@@ -291,109 +1684,194 @@ class Instruction:
             # A symbol can be a variable or a literal
             elif req_type == "symb":
                 if got_type not in ["var", "int", "string", "bool", "nil"]:
-                    code_err(53, "Wrong argument type")
+                    self.set_static_error(53, "Wrong argument type")
 
             # Otherwise the types must match exactly
             else:
                 if req_type != got_type:
-                    code_err(53, "Wrong argument type")
+                    self.set_static_error(53, "Wrong argument type")
 
-        #  Check argument data types
+        # Check data types of literals and remember variables whose data types
+        # need to be checked when executing
+        self.type_checks = []
         for i in range(len(self.args)):
-            req_type = INSTRUCTIONS[self.opcode]["data_types"][i]
+            req_type = info["data_types"][i]
             got_type = self.args[i].type
 
             # Skip if we don't care or they need to be equal
             if req_type == "any" or req_type == "eq":
                 continue
 
-            # If the argument is a variable, dig into the symtab to get the val
+            # The data type of a variable is only known at runtime
             if got_type == "var":
-                got_type = self.args[i].symb_type()
+                self.type_checks.append((self.args[i], req_type))
 
             # Check if the types match exactly
+            elif req_type != got_type:
+                self.set_static_error(53, "Wrong argument data type: requires "
+                        + req_type + " but received " + got_type)
+
+        # If the argument data types need to be equal, they can only be
+        # compared now if none of them is a variable
+        self.eq_args = []
+        if "eq" in info["data_types"]:
+            types = info["data_types"]
+            self.eq_args = [self.args[i] for i in range(len(types))
+                    if types[i] == "eq"]
+            if "var" not in [arg.type for arg in self.eq_args]:
+                error = self.eq_types_error(
+                        [arg.type for arg in self.eq_args])
+                if error != None:
+                    self.set_static_error(*error)
+                self.eq_args = []
+
+
+    # Remember the first static error found in the instruction
+    def set_static_error(self, code, text):
+        if self.static_error == None:
+            self.static_error = (code, text)
+
+
+    # Compare data types of arguments that need to be equal (provided as a
+    # list). Returns None if they match or a tuple of an error code and a
+    # message
+    def eq_types_error(self, types):
+        base_type = types[0]
+
+        # Compare data types of arguments to the one of the first argument
+        for comp_type in types[1: ]:
+
+            # Exceptions for relational operators when one type is nil
+            if "nil" in [comp_type, base_type]:
+
+                # LT and GT can't compare nils
+                if self.opcode in ["LT", "GT"]:
+                    return (53, "LT/GT instruction can't compare nils")
+
+                # EQ instruction CAN compare with nil
+                if self.opcode == "EQ":
+                    continue
+
+            # Otherwise if the types don't match, throw an error
+            if comp_type != base_type:
+                return (53, "Wrong argument data types: " + comp_type
+                        + " should be the same as " + base_type)
+
+        return None
+
+
+    # Run the instruction as a part of a program (only checks that can't be
+    # done by verify are done)
+    def run(self, prog):
+
+        # Check if variables are declared or defined
+        for var, req in self.var_checks:
+            if not prog.symtab.declared(var):
+                code_err(54, "Variable " + var.val + " not declared")
+            if req == "defined" and not prog.symtab.defined(var):
+                code_err(56, "Variable " + var.val + " not defined")
+
+        # Report an error found when verifying the instruction
+        if self.static_error != None:
+            code_err(*self.static_error)
+
+        # Check data types of variables
+        for arg, req_type in self.type_checks:
+            got_type = arg.symb_type(prog.symtab)
             if req_type != got_type:
                 code_err(53, "Wrong argument data type: requires " 
                         + req_type + " but received " + got_type)
 
-        # If the argument data types need to be equal...
-        if "eq" in INSTRUCTIONS[self.opcode]["data_types"]:
-            types = INSTRUCTIONS[self.opcode]["data_types"]
-            indices = [i for i in range(len(types)) if types[i] == "eq"]
-            base_type = self.args[indices[0]].symb_type()
-
-            # Compare data types of arguments to the one of the first argument
-            for i in indices[1: ]:
-                comp_type = self.args[i].symb_type()
-
-                # Exceptions for relational operators when one type is nil
-                if "nil" in [comp_type, base_type]:
-
-                    # LT and GT can't compare nils
-                    if self.opcode in ["LT", "GT"]:
-                        code_err(53, "LT/GT instruction can't compare nils")
-
-                    # EQ instruction CAN compare with nil
-                    if self.opcode == "EQ":
-                        continue
-
-                # Otherwise if the types don't match, throw an error
-                if comp_type != base_type:
-                    code_err(53, "Wrong argument data types: " + comp_type
-                            + " should be the same as " + base_type)
+        # Check data types that need to be equal
+        if self.eq_args:
+            error = self.eq_types_error(
+                    [arg.symb_type(prog.symtab) for arg in self.eq_args])
+            if error != None:
+                code_err(*error)
 
         # Finally, execute the instruction
-        INSTRUCTIONS[self.opcode]["function"](self.args)
+        self.function(prog, self.args)
 
 
 # Class defining an instruction argument, consisting of:
 #   order of the argument (integer)
 #   type: "var", "string", "label", "int", ...
-#   val: raw text of the argument
+#   val: text of the argument (with escape sequences of strings converted)
+#   value: value of a literal (int, bool, str or NIL)
+#   frame and name: frame ("GF", "LF" or "TF") and name of a variable
+# Arguments are not changed after the program is prepared, so they can be
+# shared by instructions (eg. when loaded from bytecode)
 class Argument:
-    def __init__(self, arg_xml):
+    def __init__(self, order, arg_type, val):
+        self.order = order
+        self.type = arg_type
+        self.val = val
 
-        # Argument tag can only be "arg1", "arg2" or "arg3"
-        if re.search("^arg[123]$", arg_xml.tag) == None:
-            code_err(32, "Received an argument with invalid tag")
+        # Index of the instruction a label points to (set when linking)
+        self.target = None
 
-        self.order = int(arg_xml.tag[-1])
-        self.type = arg_xml.attrib["type"]
-        self.val = arg_xml.text
+        # Check validity of literals (eg. bool@haha, int@a, nil@1 are invalid)
+        if (self.type == "int"
+                and LOAD_REGEXES["int"].match(self.val) == None):
+            err(53, "Invalid integer literal")
+        if self.type == "bool" and self.val not in ["true", "false"]:
+            err(53, "Invalid bool literal")
+        if self.type == "nil" and self.val != "nil":
+            err(53, "Nil data type can only contain value nil")
 
-        if self.type == "string":
+        # Split a variable to its frame and name
+        self.frame = None
+        self.name = None
+        if self.type == "var":
+            if LOAD_REGEXES["var"].match(self.val or "") == None:
+                err(32, "Invalid variable: \"" + str(self.val) + "\"")
+            self.frame, self.name = self.val.split("@", 1)
+
+        # Convert the literal to its value
+        if self.type == "int":
+            self.value = int(self.val)
+        elif self.type == "bool":
+            self.value = self.val == "true"
+        elif self.type == "nil":
+            self.value = NIL
+        else:
+            self.value = self.val
 
-            # If it is an empty string, val will be "None"
-            if self.val == None:
-                self.val = ""
+        # Data type and value of a literal together (as stored in the symtab)
+        self.literal = (self.type, self.value)
 
-            # Convert all escaped sequences to normal characters
-            while re.search("\\\(\\d{1,3})", self.val) != None:
-                match = re.search("\\\(\\d{1,3})", self.val)
-                sequence = self.val[match.span()[0]: match.span()[1]]
-                self.val = self.val.replace(sequence, chr(int(sequence[1: ])))
 
-        # Check validity of literals (eg. bool@haha, int@a, nil@1 are invalid)
-        if self.type == "int" and re.search("^[+|-]?\d+$", self.val) == None:
-            code_err(53, "Invalid integer literal")
-        if self.type == "bool" and self.val not in ["true", "false"]:
-            code_err(53, "Invalid bool literal")
-        if self.type == "nil" and self.val != "nil":
-            code_err(53, "Nil data type can only contain value nil")
+    # Get symbol data type and value as a tuple (from the symtable provided if
+    # it is a variable, with a StringBuffer converted to a str)
+    def fetch(self, symtab):
+        if self.type == "var":
+            return flat_entry(symtab.get(self))
+        else:
+            return self.literal
 
 
-    # Get symbol value (from the symtable it if is a variable)
-    def symb_val(self):
+    # Get symbol value (from the symtable provided if it is a variable, with a
+    # StringBuffer converted to a str)
+    def symb_val(self, symtab):
         if self.type == "var":
-            return program.symtab.get(self.val)["val"]
+            value = symtab.get(self)[1]
+            if value.__class__ is StringBuffer:
+                return value.flat()
+            return value
         else:
-            return self.val
+            return self.value
+
+
+    # Check whether the argument is the same variable as another argument
+    def same_var(self, other):
+        return (self.type == "var" and other.type == "var"
+                and self.frame == other.frame and self.name == other.name)
 
 
-    # Get symbol data type (from the symtable it if is a variable)
-    def symb_type(self):
+    # Get symbol data type (from the symtable provided if it is a variable)
+    def symb_type(self, symtab):
         if self.type == "var":
-            return program.symtab.get(self.val)["type"]
+            return symtab.get(self)[0]
         else:
             return self.type
 
@@ -403,311 +1881,1600 @@ class Exec:
 
     # Calculates a binary mathematical operation specified by operator
     # args[0] = args[1] <operator> args[2]
-    def math_op(args, operator):
-        operand1 = int(args[1].symb_val())
-        operand2 = int(args[2].symb_val())
-        program.symtab.define(
+    def math_op(prog, args, operator):
+        prog.symtab.define(
                 args[0], 
                 "int", 
-                str(operator(operand1, operand2))
+                operator(args[1].symb_val(prog.symtab),
+                        args[2].symb_val(prog.symtab))
                 )
 
 
     # Calculates a binary relational operation specified by operator
     # args[0] = args[1] <operator> args[2]
-    def relational_op(args, operator):
-        if args[1].symb_type() == args[2].symb_type() == "int":
-            operand1 = int(args[1].symb_val())
-            operand2 = int(args[2].symb_val())
-        else:
-            # The following works for both a string and a boolean
-            operand1 = args[1].symb_val()
-            operand2 = args[2].symb_val()
-        program.symtab.define(
+    def relational_op(prog, args, operator):
+        prog.symtab.define(
                 args[0], 
                 "bool", 
-                str(operator(operand1, operand2)).lower()
+                operator(args[1].symb_val(prog.symtab),
+                        args[2].symb_val(prog.symtab))
                 )
 
 
     # Calculates a binary boolean operation specified by operator
     # args[0] = args[1] <operator> args[2]
-    def bool_binary_op(args, operator):
-        operand1 = args[1].symb_val() == "true"
-        operand2 = args[2].symb_val() == "true"
-        program.symtab.define(
+    def bool_binary_op(prog, args, operator):
+        prog.symtab.define(
                 args[0], 
                 "bool", 
-                str(operator(operand1, operand2)).lower()
+                operator(args[1].symb_val(prog.symtab),
+                        args[2].symb_val(prog.symtab))
                 )
 
 
     # MOVE
-    def e_move(args):
-        program.symtab.define(
-                args[0], 
-                args[1].symb_type(), 
-                args[1].symb_val()
-                )
+    def e_move(prog, args):
+        prog.symtab.define(args[0], *args[1].fetch(prog.symtab))
 
     # CREATEFRAME 
-    def e_createframe(args):
-        program.symtab.tf = {}
+    def e_createframe(prog, args):
+        prog.symtab.tf = {}
 
     # PUSHFRAME
-    def e_pushframe(args):
-        if program.symtab.tf == None:
+    def e_pushframe(prog, args):
+        if prog.symtab.tf == None:
             code_err(55, "Cannot push a temporary frame since none exists")
-        program.symtab.lfs.append(program.symtab.tf)
-        program.symtab.tf = None
+        prog.symtab.lfs.append(prog.symtab.tf)
+        prog.symtab.tf = None
 
     # POPFRAME
-    def e_popframe(args):
+    def e_popframe(prog, args):
         # Move LF to TF by popping from LFs
         try:
-            program.symtab.tf = program.symtab.lfs.pop()
+            prog.symtab.tf = prog.symtab.lfs.pop()
         except:
             code_err(55, "Cannot pop a temporary frame since none exists")
 
     # DEFVAR
-    def e_defvar(args):
-        program.symtab.declare(args[0])
+    def e_defvar(prog, args):
+        prog.symtab.declare(args[0])
 
     # CALL
-    def e_call(args):
-        program.return_stack.append(program.prev_instr)
-        Exec.e_jump(args)
+    def e_call(prog, args):
+        prog.return_stack.append(prog.pc)
+        Exec.e_jump(prog, args)
 
     # RETURN
-    def e_return(args):
+    def e_return(prog, args):
         try:
-            program.prev_instr = program.return_stack.pop()
+            index = prog.return_stack.pop()
         except:
             code_err(56, "Cannot return from a call, call stack is empty")
+        prog.jump_after(index)
 
     # PUSHS
-    def e_pushs(args):
-        program.data_stack.append({
-            "type": args[0].type,
-            "val": args[0].symb_val()
-            })
+    def e_pushs(prog, args):
+        prog.data_stack.append(args[0].fetch(prog.symtab))
 
     # POPS
-    def e_pops(args):
+    def e_pops(prog, args):
         try:
-            popped_item = program.data_stack.pop()
+            popped_item = prog.data_stack.pop()
         except:
             code_err(56, "Cannot pop from an empty stack")
-        program.symtab.define(
-                args[0], 
-                popped_item["type"], 
-                popped_item["val"]
-                )
+        prog.symtab.define(args[0], *popped_item)
         
     # Binary mathematical operations:
     # ADD SUB MUL IDIV
-    def e_add(args):
-        Exec.math_op(args, operator.add)
-    def e_sub(args):
-        Exec.math_op(args, operator.sub)
-    def e_mul(args):
-        Exec.math_op(args, operator.mul)
-    def e_idiv(args):
-        if int(args[2].symb_val()) == 0:
+    def e_add(prog, args):
+        Exec.math_op(prog, args, operator.add)
+    def e_sub(prog, args):
+        Exec.math_op(prog, args, operator.sub)
+    def e_mul(prog, args):
+        Exec.math_op(prog, args, operator.mul)
+    def e_idiv(prog, args):
+        if args[2].symb_val(prog.symtab) == 0:
             code_err(57, "Division by zero encountered")
-        Exec.math_op(args, operator.floordiv)
+        Exec.math_op(prog, args, operator.floordiv)
 
     # Binary relational operations:
     # LT GT EQ 
-    def e_lt(args):
-        Exec.relational_op(args, operator.__lt__)
-    def e_gt(args):
-        Exec.relational_op(args, operator.__gt__)
-    def e_eq(args):
-        Exec.relational_op(args, operator.__eq__)
+    def e_lt(prog, args):
+        Exec.relational_op(prog, args, operator.__lt__)
+    def e_gt(prog, args):
+        Exec.relational_op(prog, args, operator.__gt__)
+    def e_eq(prog, args):
+        Exec.relational_op(prog, args, operator.__eq__)
 
     # Binary boolean operations:
     # AND OR
-    def e_and(args):
-        Exec.bool_binary_op(args, operator.__and__)
-    def e_or(args):
-        Exec.bool_binary_op(args, operator.__or__)
+    def e_and(prog, args):
+        Exec.bool_binary_op(prog, args, operator.__and__)
+    def e_or(prog, args):
+        Exec.bool_binary_op(prog, args, operator.__or__)
 
     # NOT
-    def e_not(args):
-        operand = args[1].symb_val() == "true"
-        program.symtab.define(
+    def e_not(prog, args):
+        prog.symtab.define(
                 args[0], 
                 "bool", 
-                str(not operand).lower()
+                not args[1].symb_val(prog.symtab)
                 )
 
     # INT2CHAR
-    def e_int2char(args):
+    def e_int2char(prog, args):
         try:
-            result = chr(int(args[1].symb_val()))
+            result = chr(args[1].symb_val(prog.symtab))
         except:
             code_err(58, "Cannot convert integer to character: out of range")
-        program.symtab.define(
+        prog.symtab.define(
                 args[0], 
                 "string", 
                 result
                 )
 
     # STR2INT
-    def e_stri2int(args):
-        index = int(args[2].symb_val())
-        string = args[1].symb_val()
+    def e_stri2int(prog, args):
+        index = args[2].symb_val(prog.symtab)
+        string = args[1].symb_val(prog.symtab)
         if not 0 <= index < len(string):
             code_err(58, "Cannot convert character to integer: out of range")
-        program.symtab.define(
+        prog.symtab.define(
                 args[0], 
                 "int", 
-                str(ord(string[index]))
+                ord(string[index])
                 )
 
     # READ
-    def e_read(args):
-        # Read from the input file
-        line = program.input_file.readline()
-        try:
-            # If the line is empty (EOF):
-            if line == "":
-                raise Exception("Missing input")
-            # Drop the newline at the end if it exists
-            if line[-1] == "\n":
-                line = line[: -1] 
-            # Parse the input
-            if args[1].val == "int":
-                line = "int@" + str(int(line))
-            elif args[1].val == "string":
-                line = "string@" + line
-            elif args[1].val == "bool":
-                code_err(None, line)
-                line = "bool@true" if line.upper() == "TRUE" else "bool@false"
-        # If anything is wrong with the input, nil will be written
-        except:
-            line = "nil@nil"
-        program.symtab.define(
-                args[0], 
-                line.split("@", 1)[0], 
-                line.split("@", 1)[1]
-                )
+    def e_read(prog, args):
+        line = prog.input_file.readline()
+        prog.symtab.define(args[0], *parse_input(line, args[1].val))
 
     # WRITE
-    def e_write(args):
-        if args[0].symb_type() != "nil":
-            print(args[0].symb_val(), end="")
+    def e_write(prog, args):
+        symb_type, value = args[0].fetch(prog.symtab)
+        if symb_type != "nil":
+            prog.output.write(format_value(value))
 
     # CONCAT 
-    def e_concat(args):
-        program.symtab.define(
+    def e_concat(prog, args):
+        # Appending to the same variable changes its value in place
+        if args[0].same_var(args[1]):
+            prog.symtab.append(args[0], args[2].symb_val(prog.symtab))
+            return
+        prog.symtab.define(
                 args[0], 
                 "string", 
-                args[1].symb_val() + args[2].symb_val()
+                args[1].symb_val(prog.symtab) + args[2].symb_val(prog.symtab)
                 )
 
     # STRLEN
-    def e_strlen(args):
-        program.symtab.define(
+    def e_strlen(prog, args):
+        prog.symtab.define(
                 args[0], 
                 "int", 
-                len(args[1].symb_val())
+                len(args[1].symb_val(prog.symtab))
                 )
 
     # GETCHAR
-    def e_getchar(args):
-        string = args[1].symb_val()
-        index = int(args[2].symb_val())
+    def e_getchar(prog, args):
+        string = args[1].symb_val(prog.symtab)
+        index = args[2].symb_val(prog.symtab)
         if not 0 <= index < len(string):
             code_err(58, "GETCHAR: index out of range")
-        program.symtab.define(
+        prog.symtab.define(
                 args[0], 
                 "string", 
-                string[int(index)]
+                string[index]
                 )
 
     # SETCHAR
-    def e_setchar(args):
-        if len(args[2].symb_val()) < 1:
+    def e_setchar(prog, args):
+        if len(args[2].symb_val(prog.symtab)) < 1:
             code_err(58, "SETCHAR: replacement string empty")
-        if not 0 <= int(args[1].symb_val()) < len(args[0].symb_val()):
+        # The length of the string is known without converting a StringBuffer
+        if not (0 <= args[1].symb_val(prog.symtab)
+                < len(prog.symtab.get(args[0])[1])):
             code_err(58, "SETCHAR: index out of range")
-        char = args[2].symb_val()[0]
-        string = args[0].symb_val()
-        index = int(args[1].symb_val())
-        program.symtab.define(
-                args[0], 
-                "string", 
-                string[: index] + char + string[index + 1: ]
-                )
+        char = args[2].symb_val(prog.symtab)[0]
+        index = args[1].symb_val(prog.symtab)
+        prog.symtab.setchar(args[0], index, char)
 
     # TYPE
-    def e_type(args):
+    def e_type(prog, args):
         # Get the data type - if symb_type fails, the variable is declared but
         # not defined and we should return an empty string
         try:
-            symb_type = args[1].symb_type()
+            symb_type = args[1].symb_type(prog.symtab)
         except:
             symb_type = ""
-        program.symtab.define(
+        prog.symtab.define(
                 args[0], 
                 "string", 
                 symb_type
                 )
 
     # LABEL
-    def e_label(args):
-        pass # Pass, since the labels are already in the program.labels array
+    def e_label(prog, args):
+        pass # Pass, since the labels are already in the prog.labels array
 
     # JUMP
-    def e_jump(args):
-        program.jump_to_label(args[0].symb_val())
+    def e_jump(prog, args):
+        prog.jump_after(args[0].target)
 
     # JUMPIFEQ
-    def e_jumpifeq(args):
-        if ("nil" in [args[1].symb_type(), args[2].symb_type()] # if one is nil
-                or args[1].symb_type() == args[2].symb_type()): # if they equal
-            if args[1].symb_val() == args[2].symb_val():
-                Exec.e_jump([args[0]])
+    def e_jumpifeq(prog, args):
+        type1, value1 = args[1].fetch(prog.symtab)
+        type2, value2 = args[2].fetch(prog.symtab)
+        if ("nil" in [type1, type2] # if one is nil
+                or type1 == type2): # if they equal
+            if value1 == value2:
+                Exec.e_jump(prog, [args[0]])
         else:
             code_err(53, "JUMPIFEQ: data types not compatible")
 
     # JUMPIFNEQ
-    def e_jumpifneq(args):
-        if ("nil" in [args[1].symb_type(), args[2].symb_type()] # if one is nil
-                or args[1].symb_type() == args[2].symb_type()): # if they equal
-            if args[1].symb_val() != args[2].symb_val():
-                Exec.e_jump([args[0]])
+    def e_jumpifneq(prog, args):
+        type1, value1 = args[1].fetch(prog.symtab)
+        type2, value2 = args[2].fetch(prog.symtab)
+        if ("nil" in [type1, type2] # if one is nil
+                or type1 == type2): # if they equal
+            if value1 != value2:
+                Exec.e_jump(prog, [args[0]])
         else:
             code_err(53, "JUMPIFNEQ: data types not compatible")
 
     # EXIT
-    def e_exit(args):
-        if not 0 <= int(args[0].symb_val()) <= 49:
+    def e_exit(prog, args):
+        if not 0 <= args[0].symb_val(prog.symtab) <= 49:
             code_err(57, "Exit value is out of range of allowed values")
-        exit(int(args[0].symb_val()))
+        raise InterpretExit(args[0].symb_val(prog.symtab))
 
     # DPRINT
-    def e_dprint(args):
-        code_err(None, args[0].symb_val())
+    def e_dprint(prog, args):
+        prog.debug(format_value(args[0].symb_val(prog.symtab)))
 
     # BREAK
-    def e_break(args):
-        code_err(None, "Debugging info: ==================================")
-        code_err(None, "Executing instruction #" + str(order))
-        code_err(None, "Stack of instruction orders to return to:")
-        code_err(None, "  " + str(program.return_stack))
-        code_err(None, "Data stack contents: ")
-        code_err(None, "  " + str(program.data_stack))
-        code_err(None, "Symbol table contents:")
-        code_err(None, "  Global frame: ")
-        code_err(None, "    " + str(program.symtab.gf))
-        code_err(None, "  Local frames: ")
-        code_err(None, "    " + str(program.symtab.lfs))
-        code_err(None, "  Temporary frame: ")
-        code_err(None, "    " + str(program.symtab.tf))
-        code_err(None, "==================================================")
+    def e_break(prog, args):
+        prog.debug("Debugging info: ==================================")
+        prog.debug("Executing instruction #" 
+                + str(prog.instructions[prog.pc].order))
+        prog.debug("Stack of instruction orders to return to:")
+        prog.debug("  " + str([prog.instructions[i].order 
+                for i in prog.return_stack]))
+        prog.debug("Data stack contents: ")
+        prog.debug("  " + str(prog.data_stack))
+        prog.debug("Symbol table contents:")
+        prog.debug("  Global frame: ")
+        prog.debug("    " + str(prog.symtab.gf))
+        prog.debug("  Local frames: ")
+        prog.debug("    " + str(prog.symtab.lfs))
+        prog.debug("  Temporary frame: ")
+        prog.debug("    " + str(prog.symtab.tf))
+        prog.debug("==================================================")
+
+
+# A class containing functions that compile IPPcode22 instructions to closures
+# (used by Program.run_closures). Every closure executes one instruction with
+# its operands already resolved and returns the index of the instruction to be
+# executed next. The checks and error messages are the same as in
+# Instruction.run and Exec
+class Closures:
+
+    # Returns a function returning the frame of a variable
+    def frame(prog, var):
+        symtab = prog.symtab
+        if var.frame == "GF":
+            gf = symtab.gf
+            return lambda: gf
+        elif var.frame == "TF":
+            def frame():
+                if symtab.tf == None:
+                    code_err(55, "Trying to use non-existant temporary frame")
+                return symtab.tf
+        else:
+            def frame():
+                if len(symtab.lfs) == 0:
+                    code_err(55, "Trying to use non-existant local frame")
+                return symtab.lfs[-1]
+        return frame
+
+
+    # Returns a function returning the frame of a variable which needs to be
+    # declared (the result of an instruction will be stored in it)
+    def dest(prog, var):
+        name = var.name
+        not_declared = "Variable " + var.val + " not declared"
+        if var.frame == "GF":
+            gf = prog.symtab.gf
+            def dest():
+                if name not in gf:
+                    code_err(54, not_declared)
+                return gf
+        else:
+            frame = Closures.frame(prog, var)
+            def dest():
+                current = frame()
+                if name not in current:
+                    code_err(54, not_declared)
+                return current
+        return dest
+
+
+    # Returns a function returning a tuple of the data type and value of a
+    # symbol (a literal or a variable which needs to be defined). The value of
+    # a variable which can contain a StringBuffer is converted to a str
+    def source(prog, symb):
+        if symb.type != "var":
+            literal = symb.literal
+            return lambda: literal
+        if symb.name in prog.buffer_names:
+            entry = Closures.entry(prog, symb)
+            return lambda: flat_entry(entry())
+        return Closures.entry(prog, symb)
+
+
+    # Returns a function returning a tuple of the data type and value of a
+    # variable which needs to be defined (as it is stored)
+    def entry(prog, symb):
+        name = symb.name
+        not_declared = "Variable " + symb.val + " not declared"
+        not_defined = "Variable " + symb.val + " not defined"
+        if symb.frame == "GF":
+            gf = prog.symtab.gf
+            def source():
+                entry = gf.get(name)
+                if entry == None:
+                    code_err(54, not_declared)
+                if entry[0] == None:
+                    code_err(56, not_defined)
+                return entry
+        else:
+            frame = Closures.frame(prog, symb)
+            def source():
+                entry = frame().get(name)
+                if entry == None:
+                    code_err(54, not_declared)
+                if entry[0] == None:
+                    code_err(56, not_defined)
+                return entry
+        return source
+
+
+    # Report a wrong data type of an argument
+    def wrong_type(req_type, got_type):
+        code_err(53, "Wrong argument data type: requires " 
+                + req_type + " but received " + got_type)
+
+
+    # Compile an instruction computing args[0] = function(args[1]) from a value
+    # of the required data type to a value of the result_type
+    def unary(prog, instr, index, result_type, function):
+        req_type = INSTRUCTIONS[instr.opcode]["data_types"][1]
+        dest = Closures.dest(prog, instr.args[0])
+        source = Closures.source(prog, instr.args[1])
+        name = instr.args[0].name
+        following = index + 1
+        def step():
+            frame = dest()
+            symb_type, value = source()
+            if symb_type != req_type:
+                Closures.wrong_type(req_type, symb_type)
+            frame[name] = (result_type, function(value))
+            return following
+        return step
+
+
+    # Compile an instruction computing args[0] = function(args[1], args[2])
+    # from values of the required data types to a value of the result_type
+    def binary(prog, instr, index, result_type, function):
+        _, req_type1, req_type2 = INSTRUCTIONS[instr.opcode]["data_types"]
+        dest = Closures.dest(prog, instr.args[0])
+        source1 = Closures.source(prog, instr.args[1])
+        source2 = Closures.source(prog, instr.args[2])
+        name = instr.args[0].name
+        following = index + 1
+        def step():
+            frame = dest()
+            type1, value1 = source1()
+            type2, value2 = source2()
+            if type1 != req_type1:
+                Closures.wrong_type(req_type1, type1)
+            if type2 != req_type2:
+                Closures.wrong_type(req_type2, type2)
+            frame[name] = (result_type, function(value1, value2))
+            return following
+        return step
+
+
+    # Compile a relational operation (the data types need to be equal)
+    # args[0] = args[1] <function> args[2]
+    def relational(prog, instr, index, function):
+        dest = Closures.dest(prog, instr.args[0])
+        source1 = Closures.source(prog, instr.args[1])
+        source2 = Closures.source(prog, instr.args[2])
+        name = instr.args[0].name
+        following = index + 1
+        def step():
+            frame = dest()
+            type1, value1 = source1()
+            type2, value2 = source2()
+            if type1 != type2 or type1 == "nil":
+                error = instr.eq_types_error([type1, type2])
+                if error != None:
+                    code_err(*error)
+            frame[name] = ("bool", function(value1, value2))
+            return following
+        return step
+
+
+    # Compile a conditional jump, jumping if function(args[1], args[2])
+    def conditional_jump(prog, instr, index, function):
+        source1 = Closures.source(prog, instr.args[1])
+        source2 = Closures.source(prog, instr.args[2])
+        target = instr.args[0].target + 1
+        following = index + 1
+        error = instr.opcode + ": data types not compatible"
+        def step():
+            type1, value1 = source1()
+            type2, value2 = source2()
+            if type1 != type2 and type1 != "nil" and type2 != "nil":
+                code_err(53, error)
+            if function(value1, value2):
+                return target
+            return following
+        return step
+
+
+    # Compile an instruction which is run using Instruction.run (instructions
+    # that are not worth compiling or that contain a static error)
+    def c_generic(prog, instr, index):
+        def step():
+            instr.run(prog)
+            return prog.pc + 1
+        return step
+
+
+    # Functions computing results of instructions (only when the data types
+    # are already checked)
+
+    def idiv(value1, value2):
+        if value2 == 0:
+            code_err(57, "Division by zero encountered")
+        return value1 // value2
+
+    def int2char(value):
+        try:
+            return chr(value)
+        except:
+            code_err(58, "Cannot convert integer to character: out of range")
+
+    def stri2int(string, index):
+        if not 0 <= index < len(string):
+            code_err(58, "Cannot convert character to integer: out of range")
+        return ord(string[index])
+
+    def getchar(string, index):
+        if not 0 <= index < len(string):
+            code_err(58, "GETCHAR: index out of range")
+        return string[index]
+
+
+    # MOVE
+    def c_move(prog, instr, index):
+        dest = Closures.dest(prog, instr.args[0])
+        source = Closures.source(prog, instr.args[1])
+        name = instr.args[0].name
+        following = index + 1
+        def step():
+            frame = dest()
+            frame[name] = source()
+            return following
+        return step
+
+    # CREATEFRAME
+    def c_createframe(prog, instr, index):
+        symtab = prog.symtab
+        following = index + 1
+        def step():
+            symtab.tf = {}
+            return following
+        return step
+
+    # DEFVAR
+    def c_defvar(prog, instr, index):
+        symtab = prog.symtab
+        var = instr.args[0]
+        following = index + 1
+        def step():
+            symtab.declare(var)
+            return following
+        return step
+
+    # CALL
+    def c_call(prog, instr, index):
+        return_stack = prog.return_stack
+        target = instr.args[0].target + 1
+        def step():
+            return_stack.append(index)
+            return target
+        return step
+
+    # RETURN
+    def c_return(prog, instr, index):
+        return_stack = prog.return_stack
+        def step():
+            if len(return_stack) == 0:
+                code_err(56, "Cannot return from a call, call stack is empty")
+            return return_stack.pop() + 1
+        return step
+
+    # PUSHS
+    def c_pushs(prog, instr, index):
+        data_stack = prog.data_stack
+        source = Closures.source(prog, instr.args[0])
+        following = index + 1
+        def step():
+            data_stack.append(source())
+            return following
+        return step
+
+    # POPS
+    def c_pops(prog, instr, index):
+        data_stack = prog.data_stack
+        dest = Closures.dest(prog, instr.args[0])
+        name = instr.args[0].name
+        following = index + 1
+        def step():
+            frame = dest()
+            if len(data_stack) == 0:
+                code_err(56, "Cannot pop from an empty stack")
+            frame[name] = data_stack.pop()
+            return following
+        return step
+
+    # Binary mathematical operations:
+    # ADD SUB MUL IDIV
+    def c_add(prog, instr, index):
+        return Closures.binary(prog, instr, index, "int", operator.add)
+    def c_sub(prog, instr, index):
+        return Closures.binary(prog, instr, index, "int", operator.sub)
+    def c_mul(prog, instr, index):
+        return Closures.binary(prog, instr, index, "int", operator.mul)
+    def c_idiv(prog, instr, index):
+        return Closures.binary(prog, instr, index, "int", Closures.idiv)
+
+    # Binary relational operations:
+    # LT GT EQ
+    def c_lt(prog, instr, index):
+        return Closures.relational(prog, instr, index, operator.__lt__)
+    def c_gt(prog, instr, index):
+        return Closures.relational(prog, instr, index, operator.__gt__)
+    def c_eq(prog, instr, index):
+        return Closures.relational(prog, instr, index, operator.__eq__)
+
+    # Binary boolean operations:
+    # AND OR
+    def c_and(prog, instr, index):
+        return Closures.binary(prog, instr, index, "bool", operator.__and__)
+    def c_or(prog, instr, index):
+        return Closures.binary(prog, instr, index, "bool", operator.__or__)
+
+    # NOT
+    def c_not(prog, instr, index):
+        return Closures.unary(prog, instr, index, "bool", operator.not_)
+
+    # INT2CHAR
+    def c_int2char(prog, instr, index):
+        return Closures.unary(prog, instr, index, "string", Closures.int2char)
+
+    # STRI2INT
+    def c_stri2int(prog, instr, index):
+        return Closures.binary(prog, instr, index, "int", Closures.stri2int)
+
+    # READ
+    def c_read(prog, instr, index):
+        dest = Closures.dest(prog, instr.args[0])
+        name = instr.args[0].name
+        literal_type = instr.args[1].val
+        readline = prog.input_file.readline
+        following = index + 1
+        def step():
+            frame = dest()
+            frame[name] = parse_input(readline(), literal_type)
+            return following
+        return step
+
+    # WRITE
+    def c_write(prog, instr, index):
+        source = Closures.source(prog, instr.args[0])
+        following = index + 1
+        write = prog.output.write
+        def step():
+            symb_type, value = source()
+            if symb_type != "nil":
+                write(format_value(value))
+            return following
+        return step
+
+    # CONCAT
+    def c_concat(prog, instr, index):
+        if not instr.args[0].same_var(instr.args[1]):
+            return Closures.binary(prog, instr, index, "string", operator.add)
+
+        # Appending to the same variable changes its value in place
+        dest = Closures.dest(prog, instr.args[0])
+        source = Closures.source(prog, instr.args[2])
+        name = instr.args[0].name
+        not_defined = "Variable " + instr.args[0].val + " not defined"
+        following = index + 1
+        def step():
+            frame = dest()
+            type1, value = frame[name]
+            if type1 == None:
+                code_err(56, not_defined)
+            type2, string = source()
+            if type1 != "string":
+                Closures.wrong_type("string", type1)
+            if type2 != "string":
+                Closures.wrong_type("string", type2)
+            if value.__class__ is not StringBuffer:
+                value = StringBuffer(value)
+                frame[name] = ("string", value)
+            value.append(string)
+            return following
+        return step
+
+    # STRLEN
+    def c_strlen(prog, instr, index):
+        return Closures.unary(prog, instr, index, "int", len)
+
+    # GETCHAR
+    def c_getchar(prog, instr, index):
+        return Closures.binary(prog, instr, index, "string", Closures.getchar)
+
+    # SETCHAR (the value of the variable is changed in place)
+    def c_setchar(prog, instr, index):
+        dest = Closures.dest(prog, instr.args[0])
+        source1 = Closures.source(prog, instr.args[1])
+        source2 = Closures.source(prog, instr.args[2])
+        name = instr.args[0].name
+        not_defined = "Variable " + instr.args[0].val + " not defined"
+        following = index + 1
+        def step():
+            frame = dest()
+            type0, string = frame[name]
+            if type0 == None:
+                code_err(56, not_defined)
+            type1, index = source1()
+            type2, char = source2()
+            if type0 != "string":
+                Closures.wrong_type("string", type0)
+            if type1 != "int":
+                Closures.wrong_type("int", type1)
+            if type2 != "string":
+                Closures.wrong_type("string", type2)
+            if len(char) < 1:
+                code_err(58, "SETCHAR: replacement string empty")
+            if not 0 <= index < len(string):
+                code_err(58, "SETCHAR: index out of range")
+            if string.__class__ is not StringBuffer:
+                string = StringBuffer(string)
+                frame[name] = ("string", string)
+            string.setchar(index, char[0])
+            return following
+        return step
+
+    # TYPE
+    def c_type(prog, instr, index):
+        dest = Closures.dest(prog, instr.args[0])
+        name = instr.args[0].name
+        following = index + 1
+
+        # The type of a literal is known already
+        if instr.args[1].type != "var":
+            result = ("string", instr.args[1].type)
+            def step():
+                frame = dest()
+                frame[name] = result
+                return following
+            return step
+
+        # The variable only needs to be declared (its type is an empty string
+        # if it isn't defined)
+        var = Closures.dest(prog, instr.args[1])
+        var_name = instr.args[1].name
+        def step():
+            frame = dest()
+            symb_type = var()[var_name][0]
+            frame[name] = ("string", symb_type if symb_type != None else "")
+            return following
+        return step
+
+    # LABEL
+    def c_label(prog, instr, index):
+        following = index + 1
+        return lambda: following
+
+    # JUMP
+    def c_jump(prog, instr, index):
+        target = instr.args[0].target + 1
+        return lambda: target
+
+    # JUMPIFEQ
+    def c_jumpifeq(prog, instr, index):
+        return Closures.conditional_jump(prog, instr, index, operator.__eq__)
+
+    # JUMPIFNEQ
+    def c_jumpifneq(prog, instr, index):
+        return Closures.conditional_jump(prog, instr, index, operator.__ne__)
+
+    # EXIT
+    def c_exit(prog, instr, index):
+        source = Closures.source(prog, instr.args[0])
+        def step():
+            symb_type, value = source()
+            if symb_type != "int":
+                Closures.wrong_type("int", symb_type)
+            if not 0 <= value <= 49:
+                code_err(57, "Exit value is out of range of allowed values")
+            raise InterpretExit(value)
+        return step
+
+
+# A class containing constant folding and propagation (used by
+# Program.compile_closures with the optimization level 1). Operations whose
+# operands are all literals are folded to MOVEs of their results. Variables of
+# the global frame which are assigned exactly once, by an instruction always
+# executed before all others following it (before the first label, jump, call,
+# return or exit), are replaced by their values in the following instructions.
+# The instructions are copied (errors are still reported with the original
+# ones) and an operation which would fail (eg. IDIV by zero) is not folded, so
+# it fails at runtime the same way
+class Folding:
+
+    # Fold and propagate the constants of a program. Returns a list of the
+    # instructions to be compiled and the amounts of folded operations and
+    # propagated operands
+    def fold(prog):
+        instructions = prog.instructions
+
+        # Count instructions assigning to every variable of the global frame
+        writers = {}
+        for instruction in instructions:
+            if (INSTRUCTIONS[instruction.opcode]["types"][: 1] == ["var"]
+                    and instruction.opcode != "DEFVAR"
+                    and instruction.args[0].frame == "GF"):
+                name = instruction.args[0].name
+                writers[name] = writers.get(name, 0) + 1
+
+        # Instructions before the first label and up to the first jump, call,
+        # return or exit are executed once, in their order, before the rest
+        prefix = len(instructions)
+        for index, instruction in enumerate(instructions):
+            if instruction.opcode == "LABEL":
+                prefix = index
+                break
+            if instruction.opcode in BLOCK_ENDS:
+                prefix = index + 1
+                break
+
+        # Folded operations are evaluated by a program of their own
+        scratch = Program(None, instructions, {})
+        constants = {}
+        counts = {"folded": 0, "propagated": 0}
+        result = []
+        for index, instruction in enumerate(instructions):
+            if instruction.static_error == None:
+                instruction = Folding.propagate(instruction, constants, counts)
+            literal = None
+            if instruction.static_error != None:
+                pass
+            elif (instruction.opcode == "MOVE"
+                    and instruction.args[1].type != "var"):
+                literal = instruction.args[1].literal
+            elif (instruction.opcode in FOLDABLE and "var" not in
+                    [arg.type for arg in instruction.args[1: ]]):
+                literal = Folding.evaluate(scratch, instruction)
+                if literal != None:
+                    instruction = Folding.copy(instruction, "MOVE",
+                            [instruction.args[0], Folding.argument(2,
+                                literal)])
+                    counts["folded"] += 1
+
+            # Remember the value of a variable assigned exactly once
+            if literal != None and index < prefix:
+                var = instruction.args[0]
+                if var.frame == "GF" and writers[var.name] == 1:
+                    constants[var.name] = literal
+            result.append(instruction)
+        return result, counts
+
+
+    # Replace the variables of an instruction (used as symbols) whose values
+    # are known by literals. Returns a copy of the instruction if any of them
+    # were replaced (and it has no static error afterwards), otherwise the
+    # instruction itself
+    def propagate(instruction, constants, counts):
+        types = INSTRUCTIONS[instruction.opcode]["types"]
+        args = list(instruction.args)
+        replaced = 0
+        for i, arg in enumerate(args):
+            if (types[i] == "symb" and arg.type == "var" and arg.frame == "GF"
+                    and arg.name in constants):
+                args[i] = Folding.argument(arg.order, constants[arg.name])
+                replaced += 1
+        if replaced == 0:
+            return instruction
+        copy = Folding.copy(instruction, instruction.opcode, args)
+        if copy.static_error != None:
+            return instruction
+        counts["propagated"] += replaced
+        return copy
+
+
+    # Get the result of an operation whose operands are all literals (a tuple
+    # of its data type and value), or None if it fails
+    def evaluate(scratch, instruction):
+        var = instruction.args[0]
+        symtab = scratch.symtab = SymTab()
+        symtab.tf = {}
+        symtab.lfs.append({})
+        symtab.declare(var)
+        try:
+            instruction.run(scratch)
+        except InterpretExit:
+            return None
+        return symtab.get(var)
+
+
+    # Create a verified copy of an instruction with another opcode and
+    # arguments (it keeps the order of the instruction)
+    def copy(instruction, opcode, args):
+        copy = Instruction(opcode, instruction.order)
+        copy.args = args
+        copy.verify()
+        return copy
+
+
+    # Create a literal argument from a tuple of its data type and value
+    def argument(order, literal):
+        literal_type, value = literal
+        if literal_type == "bool":
+            val = "true" if value else "false"
+        elif literal_type == "nil":
+            val = "nil"
+        else:
+            val = str(value)
+        return Argument(order, literal_type, val)
+
+
+# A class containing a peephole optimization of a program compiled to closures
+# (used by Program.compile_closures with the optimization level 1). Sequences
+# of instructions which are common in IPPcode22 programs are fused to
+# superinstructions, closures executing the whole sequence at once. A fused
+# closure replaces only the closure of the first instruction of its sequence,
+# so jumps into the middle of the sequence still run the original closures.
+# When an instruction of the sequence fails, the program counter is set to it
+# before the error is propagated, so it is reported with the same order
+class Superinstructions:
+
+    # Fuse all sequences found in the instructions provided, given the list of
+    # their closures (see FUSIONS, the sequences are searched in the order of
+    # the instructions and do not overlap). Returns the amounts of fusions by
+    # the names of the patterns
+    def fuse(prog, instructions, code):
+        counts = {}
+        index = 0
+        while index < len(code):
+            for name, pattern in FUSIONS:
+                fused = pattern(prog, instructions, code, index)
+                if fused != None:
+                    length, code[index] = fused
+                    counts[name] = counts.get(name, 0) + 1
+                    index += length - 1
+                    break
+            index += 1
+        return counts
+
+
+    # Check whether the instructions from the index provided have the opcodes
+    # provided (a list of lists of allowed opcodes) and no static errors
+    def match(instructions, index, opcodes):
+        instructions = instructions[index : index + len(opcodes)]
+        if len(instructions) < len(opcodes):
+            return False
+        for instruction, allowed in zip(instructions, opcodes):
+            if (instruction.opcode not in allowed
+                    or instruction.static_error != None):
+                return False
+        return True
+
+
+    # ADD, SUB or MUL followed by JUMPIFEQ or JUMPIFNEQ (eg. a counter of a
+    # loop being incremented and compared). The result is passed to the jump
+    # right away when it compares the variable the result is stored in
+    def arithmetic_jump(prog, instructions, code, index):
+        if not Superinstructions.match(instructions, index,
+                [["ADD", "SUB", "MUL"], ["JUMPIFEQ", "JUMPIFNEQ"]]):
+            return None
+        arithmetic, jump = instructions[index : index + 2]
+        function = {"ADD": operator.add, "SUB": operator.sub,
+                "MUL": operator.mul}[arithmetic.opcode]
+        compare = {"JUMPIFEQ": operator.__eq__,
+                "JUMPIFNEQ": operator.__ne__}[jump.opcode]
+        var = arithmetic.args[0]
+        dest = Closures.dest(prog, var)
+        source1 = Closures.source(prog, arithmetic.args[1])
+        source2 = Closures.source(prog, arithmetic.args[2])
+        reuse3 = var.same_var(jump.args[1])
+        reuse4 = var.same_var(jump.args[2])
+        source3 = Closures.source(prog, jump.args[1])
+        source4 = Closures.source(prog, jump.args[2])
+        name = var.name
+        target = jump.args[0].target + 1
+        following = index + 2
+        error = jump.opcode + ": data types not compatible"
+        def step():
+            frame = dest()
+            type1, value1 = source1()
+            type2, value2 = source2()
+            if type1 != "int":
+                Closures.wrong_type("int", type1)
+            if type2 != "int":
+                Closures.wrong_type("int", type2)
+            result = ("int", function(value1, value2))
+            frame[name] = result
+            try:
+                type3, value3 = result if reuse3 else source3()
+                type4, value4 = result if reuse4 else source4()
+                if type3 != type4 and type3 != "nil" and type4 != "nil":
+                    code_err(53, error)
+            except InterpretError:
+                prog.pc = index + 1
+                raise
+            if compare(value3, value4):
+                return target
+            return following
+        return 2, step
+
+
+    # PUSHS followed by POPS (a value moved through the data stack, which
+    # stays the same)
+    def push_pop(prog, instructions, code, index):
+        if not Superinstructions.match(instructions, index,
+                [["PUSHS"], ["POPS"]]):
+            return None
+        push, pop = instructions[index : index + 2]
+        source = Closures.source(prog, push.args[0])
+        dest = Closures.dest(prog, pop.args[0])
+        name = pop.args[0].name
+        following = index + 2
+        def step():
+            entry = source()
+            try:
+                frame = dest()
+            except InterpretError:
+                prog.pc = index + 1
+                raise
+            frame[name] = entry
+            return following
+        return 2, step
+
+
+    # At least two MOVEs in a row
+    def move_chain(prog, instructions, code, index):
+        length = 0
+        while Superinstructions.match(instructions, index + length,
+                [["MOVE"]]):
+            length += 1
+        if length < 2:
+            return None
+        moves = []
+        for instruction in instructions[index : index + length]:
+            moves.append((Closures.dest(prog, instruction.args[0]),
+                Closures.source(prog, instruction.args[1]),
+                instruction.args[0].name))
+        following = index + length
+        def step():
+            stage = index
+            try:
+                for dest, source, name in moves:
+                    frame = dest()
+                    frame[name] = source()
+                    stage += 1
+            except InterpretError:
+                prog.pc = stage
+                raise
+            return following
+        return length, step
+
+
+    # CREATEFRAME, any DEFVARs and MOVEs (usually defining the arguments in
+    # the new temporary frame) and PUSHFRAME, optionally followed by CALL (a
+    # call of a function or the start of a function)
+    def frame_setup(prog, instructions, code, index):
+        if not Superinstructions.match(instructions, index,
+                [["CREATEFRAME"]]):
+            return None
+        length = 1
+        while Superinstructions.match(instructions, index + length,
+                [["DEFVAR", "MOVE"]]):
+            length += 1
+        if not Superinstructions.match(instructions, index + length,
+                [["PUSHFRAME"]]):
+            return None
+        parts = code[index + 1 : index + length]
+        symtab = prog.symtab
+        return_stack = prog.return_stack
+        call = index + length + 1
+        if not Superinstructions.match(instructions, call, [["CALL"]]):
+            following = call
+            def step():
+                frame = {}
+                symtab.tf = frame
+                stage = index + 1
+                try:
+                    for part in parts:
+                        part()
+                        stage += 1
+                except InterpretError:
+                    prog.pc = stage
+                    raise
+                symtab.lfs.append(frame)
+                symtab.tf = None
+                return following
+            return length + 1, step
+        target = instructions[call].args[0].target + 1
+        def step():
+            frame = {}
+            symtab.tf = frame
+            stage = index + 1
+            try:
+                for part in parts:
+                    part()
+                    stage += 1
+            except InterpretError:
+                prog.pc = stage
+                raise
+            symtab.lfs.append(frame)
+            symtab.tf = None
+            return_stack.append(call)
+            return target
+        return length + 2, step
+
+
+# A class transpiling the instructions of a program to python source code (used
+# by Program.run_transpiled). The instructions are split to basic blocks (a
+# block starts at the first instruction, at a label and after a jump, call,
+# return or exit) and every block is transpiled to a python function returning
+# the index of the instruction to be executed next. The checks and error
+# messages are the same as in Instruction.run and Exec
+class Transpiler:
+    def __init__(self, instructions):
+        self.instructions = instructions
+        self.lines = []
+        self.indent = 0
+
+        # Names of variables which can contain a StringBuffer
+        self.buffer_names = buffer_names(instructions)
+
+
+    # Get the source code of a python module defining a function for every
+    # block and a dictionary BLOCKS of these functions by indices of the first
+    # instructions of the blocks. The module needs these globals: P (program),
+    # S (symtab), GF (global frame), R (return stack), D (data stack),
+    # I (instructions), E (function reporting an error at an instruction),
+    # B (StringBuffer), F (flat_entry) and NIL, format_value
+    def source(self):
+        self.lines = ["# IPPcode22 program transpiled by interpret.py", ""]
+        leaders = self.leaders()
+        for i in range(len(leaders)):
+            start = leaders[i]
+            end = leaders[i + 1] if i + 1 < len(leaders) else len(
+                    self.instructions)
+            self.block(start, end)
+        self.lines.append("BLOCKS = {" + ", ".join(
+            [str(start) + ": b" + str(start) for start in leaders]) + "}")
+        return "\n".join(self.lines) + "\n"
+
+
+    # Get indices of the first instructions of all blocks
+    def leaders(self):
+        leaders = [0]
+        for index, instruction in enumerate(self.instructions):
+            if index == 0:
+                continue
+            previous = self.instructions[index - 1].opcode
+            if (instruction.opcode == "LABEL"
+                    or previous in BLOCK_ENDS):
+                leaders.append(index)
+        return leaders
+
+
+    # Add a line of code
+    def emit(self, line):
+        self.lines.append("    " * self.indent + line)
+
+
+    # Add a line reporting an error at an instruction
+    def emit_error(self, index, code, text):
+        self.emit("E(" + str(index) + ", " + str(code) + ", " + repr(text)
+                + ")")
+
+
+    # Transpile a block (instructions from start to end) to a function
+    def block(self, start, end):
+        self.emit("def b" + str(start) + "():")
+        self.indent += 1
+        for index in range(start, end):
+            instruction = self.instructions[index]
+            self.emit("# " + str(instruction.order) + ": " + " ".join(
+                [instruction.opcode] + [repr(arg.val) for arg in
+                    instruction.args]))
+
+            # Instructions that are not transpiled are run by Instruction.run
+            transpile = INSTRUCTIONS[instruction.opcode]["transpile"]
+            if instruction.static_error != None or transpile == None:
+                self.emit("P.pc = " + str(index))
+                self.emit("I[" + str(index) + "].run(P)")
+                if instruction.opcode in BLOCK_ENDS:
+                    self.emit("return P.pc + 1")
+            else:
+                transpile(self, instruction, index)
+
+        # Continue with the following block
+        if self.instructions[end - 1].opcode not in BLOCK_ENDS:
+            self.emit("return " + str(end))
+        self.indent -= 1
+        self.lines.append("")
+
+
+    # Add code getting the frame of a variable, returns its expression
+    def frame(self, index, var, i):
+        if var.frame == "GF":
+            return "GF"
+        elif var.frame == "TF":
+            self.emit("f" + str(i) + " = S.tf")
+            self.emit("if f" + str(i) + " is None:")
+            self.indent += 1
+            self.emit_error(index, 55,
+                    "Trying to use non-existant temporary frame")
+            self.indent -= 1
+        else:
+            self.emit("if not S.lfs:")
+            self.indent += 1
+            self.emit_error(index, 55, "Trying to use non-existant local frame")
+            self.indent -= 1
+            self.emit("f" + str(i) + " = S.lfs[-1]")
+        return "f" + str(i)
+
+
+    # Add code checking that a variable (the i-th argument) is declared,
+    # returns the expression of its frame
+    def dest(self, index, var, i):
+        frame = self.frame(index, var, i)
+        self.emit("if " + repr(var.name) + " not in " + frame + ":")
+        self.indent += 1
+        self.emit_error(index, 54, "Variable " + var.val + " not declared")
+        self.indent -= 1
+        return frame
+
+
+    # Add code getting the data type and value of a symbol (the i-th argument)
+    # which needs to be defined, returns expressions of the data type, value
+    # and both of them as a tuple
+    def source_symb(self, index, symb, i):
+        if symb.type != "var":
+            value = "NIL" if symb.value is NIL else repr(symb.value)
+            return (repr(symb.type), value,
+                    "(" + repr(symb.type) + ", " + value + ")")
+
+        entry = "e" + str(i)
+        frame = self.frame(index, symb, i)
+        self.emit(entry + " = " + frame + ".get(" + repr(symb.name) + ")")
+        self.emit("if " + entry + " is None:")
+        self.indent += 1
+        self.emit_error(index, 54, "Variable " + symb.val + " not declared")
+        self.indent -= 1
+        self.emit("if " + entry + "[0] is None:")
+        self.indent += 1
+        self.emit_error(index, 56, "Variable " + symb.val + " not defined")
+        self.indent -= 1
+        if symb.name in self.buffer_names:
+            self.emit(entry + " = F(" + entry + ")")
+        self.emit("t" + str(i) + ", v" + str(i) + " = " + entry)
+        return ("t" + str(i), "v" + str(i), entry)
+
+
+    # Add code checking the data type of a symbol
+    def check_type(self, index, symb, i, req_type):
+        if symb.type != "var" or req_type in ["any", "eq"]:
+            return
+        got_type = "t" + str(i)
+        self.emit("if " + got_type + " != " + repr(req_type) + ":")
+        self.indent += 1
+        self.emit("E(" + str(index) + ", 53, " + repr(
+            "Wrong argument data type: requires " + req_type
+            + " but received ") + " + " + got_type + ")")
+        self.indent -= 1
+
+
+    # Add code replacing a str value (of a variable of a frame) by a
+    # StringBuffer, so it can be changed in place
+    def buffer(self, frame, name, value):
+        self.emit("if " + value + ".__class__ is not B:")
+        self.indent += 1
+        self.emit(value + " = B(" + value + ")")
+        self.emit(frame + "[" + name + "] = ('string', " + value + ")")
+        self.indent -= 1
+
+
+    # Add code checking a condition which causes an error
+    def check(self, index, condition, code, text):
+        self.emit("if " + condition + ":")
+        self.indent += 1
+        self.emit_error(index, code, text)
+        self.indent -= 1
+
+
+    # Add code computing a value of an operation whose result is stored to the
+    # first argument. Expression is a format string using the value
+    # expressions of the other arguments ({1} and {2}), checks is a list of
+    # (condition, code, message) which cause errors
+    def operation(self, instruction, index, result_type, expression,
+            checks=[]):
+        args = instruction.args
+        data_types = INSTRUCTIONS[instruction.opcode]["data_types"]
+        frame = self.dest(index, args[0], 0)
+        values = [None]
+        types = [None]
+        for i in range(1, len(args)):
+            symb_type, value, _ = self.source_symb(index, args[i], i)
+            types.append(symb_type)
+            values.append(value)
+        for i in range(1, len(args)):
+            self.check_type(index, args[i], i, data_types[i])
+
+        # Data types which need to be equal (if they are not literals)
+        if "eq" in data_types and "var" in [arg.type for arg in args[1: ]]:
+            self.emit("if " + types[1] + " != " + types[2] + " or " + types[1]
+                    + " == 'nil':")
+            self.indent += 1
+            self.emit("error = I[" + str(index) + "].eq_types_error(["
+                    + types[1] + ", " + types[2] + "])")
+            self.emit("if error is not None:")
+            self.indent += 1
+            self.emit("E(" + str(index) + ", *error)")
+            self.indent -= 2
+
+        for condition, code, text in checks:
+            self.check(index, condition.format(*values), code, text)
+        self.emit(frame + "[" + repr(args[0].name) + "] = (" + repr(result_type)
+                + ", " + expression.format(*values) + ")")
+
+
+    # Functions transpiling the instructions (by opcode)
+
+    # MOVE
+    def t_move(self, instruction, index):
+        frame = self.dest(index, instruction.args[0], 0)
+        _, _, entry = self.source_symb(index, instruction.args[1], 1)
+        self.emit(frame + "[" + repr(instruction.args[0].name) + "] = "
+                + entry)
+
+    # CREATEFRAME
+    def t_createframe(self, instruction, index):
+        self.emit("S.tf = {}")
+
+    # PUSHFRAME
+    def t_pushframe(self, instruction, index):
+        self.check(index, "S.tf is None", 55,
+                "Cannot push a temporary frame since none exists")
+        self.emit("S.lfs.append(S.tf)")
+        self.emit("S.tf = None")
+
+    # POPFRAME
+    def t_popframe(self, instruction, index):
+        self.check(index, "not S.lfs", 55,
+                "Cannot pop a temporary frame since none exists")
+        self.emit("S.tf = S.lfs.pop()")
+
+    # DEFVAR
+    def t_defvar(self, instruction, index):
+        var = instruction.args[0]
+        frame = self.frame(index, var, 0)
+        self.check(index, repr(var.name) + " in " + frame, 52,
+                "Redeclaration of variable " + var.name)
+        self.emit(frame + "[" + repr(var.name) + "] = (None, None)")
+
+    # CALL
+    def t_call(self, instruction, index):
+        self.emit("R.append(" + str(index) + ")")
+        self.emit("return " + str(instruction.args[0].target))
+
+    # RETURN
+    def t_return(self, instruction, index):
+        self.check(index, "not R", 56,
+                "Cannot return from a call, call stack is empty")
+        self.emit("return R.pop() + 1")
+
+    # PUSHS
+    def t_pushs(self, instruction, index):
+        _, _, entry = self.source_symb(index, instruction.args[0], 0)
+        self.emit("D.append(" + entry + ")")
+
+    # POPS
+    def t_pops(self, instruction, index):
+        frame = self.dest(index, instruction.args[0], 0)
+        self.check(index, "not D", 56, "Cannot pop from an empty stack")
+        self.emit(frame + "[" + repr(instruction.args[0].name)
+                + "] = D.pop()")
+
+    # Binary mathematical operations:
+    # ADD SUB MUL IDIV
+    def t_add(self, instruction, index):
+        self.operation(instruction, index, "int", "{1} + {2}")
+    def t_sub(self, instruction, index):
+        self.operation(instruction, index, "int", "{1} - {2}")
+    def t_mul(self, instruction, index):
+        self.operation(instruction, index, "int", "{1} * {2}")
+    def t_idiv(self, instruction, index):
+        self.operation(instruction, index, "int", "{1} // {2}",
+                [("{2} == 0", 57, "Division by zero encountered")])
+
+    # Binary relational operations:
+    # LT GT EQ
+    def t_lt(self, instruction, index):
+        self.operation(instruction, index, "bool", "{1} < {2}")
+    def t_gt(self, instruction, index):
+        self.operation(instruction, index, "bool", "{1} > {2}")
+    def t_eq(self, instruction, index):
+        self.operation(instruction, index, "bool", "{1} == {2}")
+
+    # Binary boolean operations:
+    # AND OR
+    def t_and(self, instruction, index):
+        self.operation(instruction, index, "bool", "{1} and {2}")
+    def t_or(self, instruction, index):
+        self.operation(instruction, index, "bool", "{1} or {2}")
+
+    # NOT
+    def t_not(self, instruction, index):
+        self.operation(instruction, index, "bool", "not {1}")
+
+    # INT2CHAR
+    def t_int2char(self, instruction, index):
+        self.operation(instruction, index, "string", "chr({1})",
+                [("not 0 <= {1} <= 0x10ffff", 58,
+                    "Cannot convert integer to character: out of range")])
+
+    # STRI2INT
+    def t_stri2int(self, instruction, index):
+        self.operation(instruction, index, "int", "ord({1}[{2}])",
+                [("not 0 <= {2} < len({1})", 58,
+                    "Cannot convert character to integer: out of range")])
+
+    # READ
+    def t_read(self, instruction, index):
+        frame = self.dest(index, instruction.args[0], 0)
+        self.emit(frame + "[" + repr(instruction.args[0].name)
+                + "] = parse_input(RL(), " + repr(instruction.args[1].val)
+                + ")")
+
+    # WRITE
+    def t_write(self, instruction, index):
+        symb = instruction.args[0]
+        if symb.type != "var":
+            if symb.type != "nil":
+                self.emit("W(" + repr(format_value(symb.value)) + ")")
+            return
+        symb_type, value, _ = self.source_symb(index, symb, 0)
+        self.emit("if " + symb_type + " != 'nil':")
+        self.indent += 1
+        self.emit("W(format_value(" + value + "))")
+        self.indent -= 1
+
+    # CONCAT
+    def t_concat(self, instruction, index):
+        args = instruction.args
+        if not args[0].same_var(args[1]):
+            self.operation(instruction, index, "string", "{1} + {2}")
+            return
+
+        # Appending to the same variable changes its value in place
+        frame = self.dest(index, args[0], 0)
+        name = repr(args[0].name)
+        self.emit("t1, v1 = " + frame + "[" + name + "]")
+        self.check(index, "t1 is None", 56,
+                "Variable " + args[1].val + " not defined")
+        _, value, _ = self.source_symb(index, args[2], 2)
+        self.check_type(index, args[1], 1, "string")
+        self.check_type(index, args[2], 2, "string")
+        self.buffer(frame, name, "v1")
+        self.emit("v1.append(" + value + ")")
+
+    # STRLEN
+    def t_strlen(self, instruction, index):
+        self.operation(instruction, index, "int", "len({1})")
+
+    # GETCHAR
+    def t_getchar(self, instruction, index):
+        self.operation(instruction, index, "string", "{1}[{2}]",
+                [("not 0 <= {2} < len({1})", 58,
+                    "GETCHAR: index out of range")])
+
+    # SETCHAR (the value of the variable is changed in place)
+    def t_setchar(self, instruction, index):
+        args = instruction.args
+        frame = self.dest(index, args[0], 0)
+        name = repr(args[0].name)
+        self.emit("t0, v0 = " + frame + "[" + name + "]")
+        self.check(index, "t0 is None", 56,
+                "Variable " + args[0].val + " not defined")
+        values = ["v0"]
+        for i in range(1, 3):
+            values.append(self.source_symb(index, args[i], i)[1])
+        for i, req_type in enumerate(["string", "int", "string"]):
+            self.check_type(index, args[i], i, req_type)
+        self.check(index, "len({2}) < 1".format(*values), 58,
+                "SETCHAR: replacement string empty")
+        self.check(index, "not 0 <= {1} < len({0})".format(*values), 58,
+                "SETCHAR: index out of range")
+        self.buffer(frame, name, "v0")
+        self.emit("v0.setchar({1}, {2}[0])".format(*values))
+
+    # TYPE
+    def t_type(self, instruction, index):
+        args = instruction.args
+        frame = self.dest(index, args[0], 0)
+        if args[1].type != "var":
+            symb_type = repr(args[1].type)
+        else:
+            var_frame = self.dest(index, args[1], 1)
+            self.emit("t1 = " + var_frame + "[" + repr(args[1].name)
+                    + "][0]")
+            symb_type = "t1 if t1 is not None else ''"
+        self.emit(frame + "[" + repr(args[0].name) + "] = ('string', "
+                + symb_type + ")")
+
+    # LABEL
+    def t_label(self, instruction, index):
+        pass
+
+    # JUMP
+    def t_jump(self, instruction, index):
+        self.emit("return " + str(instruction.args[0].target))
+
+    # Conditional jumps, jumping if the values compared by comparison match
+    def conditional_jump(self, instruction, index, comparison):
+        args = instruction.args
+        type1, value1, _ = self.source_symb(index, args[1], 1)
+        type2, value2, _ = self.source_symb(index, args[2], 2)
+        self.check(index, type1 + " != " + type2 + " and " + type1
+                + " != 'nil' and " + type2 + " != 'nil'", 53,
+                instruction.opcode + ": data types not compatible")
+        self.emit("if " + value1 + " " + comparison + " " + value2 + ":")
+        self.indent += 1
+        self.emit("return " + str(args[0].target))
+        self.indent -= 1
+        self.emit("return " + str(index + 1))
+
+    # JUMPIFEQ
+    def t_jumpifeq(self, instruction, index):
+        self.conditional_jump(instruction, index, "==")
+
+    # JUMPIFNEQ
+    def t_jumpifneq(self, instruction, index):
+        self.conditional_jump(instruction, index, "!=")
+
+    # EXIT
+    def t_exit(self, instruction, index):
+        symb = instruction.args[0]
+        _, value, _ = self.source_symb(index, symb, 0)
+        self.check_type(index, symb, 0, "int")
+        self.check(index, "not 0 <= " + value + " <= 49", 57,
+                "Exit value is out of range of allowed values")
+        self.emit("raise InterpretExit(" + value + ")")
+
+
+# A control flow graph of a program (its sorted and linked instructions). The
+# instructions are split to basic blocks the same way as by Transpiler and
+# every block is connected to the blocks which can be executed right after it:
+# the following one (unless it ends by JUMP, RETURN or EXIT, or an instruction
+# containing a static error), the target of a jump and the target of a call
+# (RETURN continues after the call, so the block following a call is its
+# successor too). Blocks which are not reachable from the first one can never
+# be executed
+class ControlFlow:
+    def __init__(self, instructions):
+        self.instructions = instructions
+
+        # Indices of the first instructions of all blocks and the indices
+        # following their last instructions
+        self.starts = [0] if instructions != [] else []
+        for index in range(1, len(instructions)):
+            if (instructions[index].opcode == "LABEL"
+                    or instructions[index - 1].opcode in BLOCK_ENDS):
+                self.starts.append(index)
+        self.ends = self.starts[1: ] + [len(instructions)]
+
+        # Successors of every block (by its start) as tuples of their starts
+        # and the kinds of the edges
+        self.edges = {}
+        for start, end in zip(self.starts, self.ends):
+            self.edges[start] = self.successors(end)
+
+        # Starts of the blocks reachable from the first one
+        self.reachable = set()
+        pending = self.starts[: 1]
+        while pending != []:
+            start = pending.pop()
+            if start in self.reachable:
+                continue
+            self.reachable.add(start)
+            pending.extend(successor for successor, _ in self.edges[start])
+
+
+    # Get the successors of a block ending before the index provided
+    def successors(self, end):
+        last = self.instructions[end - 1]
+        following = []
+        if end < len(self.instructions):
+            following = [(end, "next")]
+
+        # An instruction containing a static error always fails
+        if last.static_error != None or last.opcode in ["RETURN", "EXIT"]:
+            return []
+        elif last.opcode == "JUMP":
+            return [(last.args[0].target, "jump")]
+        elif last.opcode in ["JUMPIFEQ", "JUMPIFNEQ"]:
+            return [(last.args[0].target, "jump")] + following
+        elif last.opcode == "CALL":
+            return [(last.args[0].target, "call")] + [
+                    (successor, "return") for successor, _ in following]
+        return following
+
+
+    # Get the instructions of all reachable blocks (in their order)
+    def reachable_instructions(self):
+        instructions = []
+        for start, end in zip(self.starts, self.ends):
+            if start in self.reachable:
+                instructions.extend(self.instructions[start : end])
+        return instructions
+
+
+    # Get the graph in the DOT format, every block is a node listing its
+    # instructions (unreachable blocks are dashed)
+    def dot(self):
+        lines = ["digraph program {",
+                "    node [shape=box, fontname=monospace];"]
+        for start, end in zip(self.starts, self.ends):
+            text = "".join(ControlFlow.describe(instruction) + "\\l"
+                    for instruction in self.instructions[start : end])
+            style = "" if start in self.reachable else ", style=dashed"
+            lines.append("    b" + str(start) + " [label=\"" + text + "\""
+                    + style + "];")
+            for successor, kind in self.edges[start]:
+                lines.append("    b" + str(start) + " -> b" + str(successor)
+                        + " [label=" + kind + "];")
+        lines.append("}")
+        return "\n".join(lines) + "\n"
+
+
+    # Describe an instruction by its order, opcode and arguments (escaped for
+    # a label in the DOT format, string literals are written with escape
+    # sequences the same way as in IPPcode22)
+    def describe(instruction):
+        words = [str(instruction.order) + ":", instruction.opcode]
+        for arg in instruction.args:
+            val = str(arg.val)
+            if arg.type == "string":
+                val = "".join(char if char > " " and char not in "#\\"
+                        else "\\" + str(ord(char)).zfill(3) for char in val)
+            words.append(arg.type + "@" + val)
+        return " ".join(words).replace("\\", "\\\\").replace("\"", "\\\"")
 
 
 #
@@ -717,7 +3484,9 @@ class Exec:
 #
 
 
-program = None
+# Arguments of the interpret (including the loaded program) used by a worker
+# of a fan-out (see run_fanout)
+fanout_args = None
 
 
 #
@@ -727,187 +3496,334 @@ program = None
 #
 
 
+# The only value of the nil data type
+NIL = Nil()
+
+
+# Version of the format of cached programs (see load_cached). Needs to be
+# increased whenever the cached classes (Instruction, Argument) change
+CACHE_VERSION = 1
+
+
+# Regex of an escape sequence of a string literal (see decode_escapes)
+ESCAPE_REGEX = re.compile(r"\\(\d{1,3})")
+
+
+# Regexes checking programs when loaded: orders of instructions and tags of
+# arguments in XML, integer literals and variables (see Argument)
+LOAD_REGEXES = {
+        "order": re.compile(r"^\d+$"),
+        "arg":   re.compile(r"^arg[123]$"),
+        "int":   re.compile(r"^[+|-]?\d+$"),
+        "var":   re.compile(r"^(GF|LF|TF)@."),
+        }
+
+
+# Regexes of arguments of instructions in the source code (the same ones as
+# used by parse.php) by their kinds and types of literals
+TEXT_REGEXES = {
+        "var":    re.compile(r"^(TF|LF|GF)@[a-zA-Z_\-$&%*!?]"
+            + r"[a-zA-Z0-9_\-$&%*!?]*$"),
+        "int":    re.compile(r"^int@[\+|\-]?[0-9]+$"),
+        "bool":   re.compile(r"^bool@(true|false)$"),
+        "string": re.compile(r"^string@([^\x00-\x20\x23\x5c]|(\\\d\d\d))*$",
+            re.ASCII),
+        "nil":    re.compile(r"^nil@nil$"),
+        "label":  re.compile(r"^[a-zA-Z_\-$&%*!?][a-zA-Z0-9_\-$&%*!?]*$"),
+        "type":   re.compile(r"^(int|bool|string|nil)$"),
+        }
+
+
+# Format of programs in bytecode (see write_bytecode): the header contains the
+# magic, version and the amounts of strings, opcodes, instructions and labels
+BYTECODE_MAGIC = b"IPPC"
+BYTECODE_VERSION = 1
+BYTECODE_HEADER = struct.Struct("<4sHIIII")
+BYTECODE_INSTRUCTION = struct.Struct("<IBB6I")
+BYTECODE_LABEL = struct.Struct("<II")
+
+
 # Instructions and information about them:
-# their corresponding functions and data types of their arguments
+# their corresponding functions (and functions compiling them to closures and
+# transpiling them to python) and data types of their arguments
 INSTRUCTIONS = {
         "MOVE":        {
             "function":     Exec.e_move,       
+            "closure":      Closures.c_move,
+            "transpile":    Transpiler.t_move,
             "types":        ["var",      "symb"    ],
             "data_types":   ["any",      "any"     ],
             "requirements": ["declared", "defined" ]},
         "CREATEFRAME": {
             "function":     Exec.e_createframe,
+            "closure":      Closures.c_createframe,
+            "transpile":    Transpiler.t_createframe,
             "types":        [],
             "data_types":   [],
             "requirements": []},
         "PUSHFRAME":   {
             "function":     Exec.e_pushframe,  
+            "closure":      Closures.c_generic,
+            "transpile":    Transpiler.t_pushframe,
             "types":        [],
             "data_types":   [],
             "requirements": []},
         "POPFRAME":    {
             "function":     Exec.e_popframe,   
+            "closure":      Closures.c_generic,
+            "transpile":    Transpiler.t_popframe,
             "types":        [],
             "data_types":   [],
             "requirements": []},
         "DEFVAR":      {
             "function":     Exec.e_defvar,     
+            "closure":      Closures.c_defvar,
+            "transpile":    Transpiler.t_defvar,
             "types":        ["var"     ],
             "data_types":   ["any"     ],
             "requirements": ["none"    ]},
         "CALL":        {
             "function":     Exec.e_call,       
+            "closure":      Closures.c_call,
+            "transpile":    Transpiler.t_call,
             "types":        ["label"   ],
             "data_types":   ["any"     ],
             "requirements": ["defined" ]},
         "RETURN":      {
             "function":     Exec.e_return,     
+            "closure":      Closures.c_return,
+            "transpile":    Transpiler.t_return,
             "types":        [],
             "data_types":   [],
             "requirements": []},
         "PUSHS":       {
             "function":     Exec.e_pushs,      
+            "closure":      Closures.c_pushs,
+            "transpile":    Transpiler.t_pushs,
             "types":        ["symb"    ],
             "data_types":   ["any"     ],
             "requirements": ["defined" ]},
         "POPS":        {
             "function":     Exec.e_pops,       
+            "closure":      Closures.c_pops,
+            "transpile":    Transpiler.t_pops,
             "types":        ["var"     ],
             "data_types":   ["any"     ],
             "requirements": ["declared"]},
         "ADD":         {
             "function":     Exec.e_add,        
+            "closure":      Closures.c_add,
+            "transpile":    Transpiler.t_add,
             "types":        ["var",      "symb",     "symb"    ],
             "data_types":   ["any",      "int",      "int"     ],
             "requirements": ["declared", "defined",  "defined" ]},
         "SUB":         {
             "function":     Exec.e_sub,        
+            "closure":      Closures.c_sub,
+            "transpile":    Transpiler.t_sub,
             "types":        ["var",      "symb",     "symb"    ],
             "data_types":   ["any",      "int",      "int"     ],
             "requirements": ["declared", "defined",  "defined" ]},
         "MUL":         {
             "function":     Exec.e_mul,        
+            "closure":      Closures.c_mul,
+            "transpile":    Transpiler.t_mul,
             "types":        ["var",      "symb",     "symb"    ],
             "data_types":   ["any",      "int",      "int"     ],
             "requirements": ["declared", "defined",  "defined" ]},
         "IDIV":        {
             "function":     Exec.e_idiv,       
+            "closure":      Closures.c_idiv,
+            "transpile":    Transpiler.t_idiv,
             "types":        ["var",      "symb",     "symb"    ],
             "data_types":   ["any",      "int",      "int"     ],
             "requirements": ["declared", "defined",  "defined" ]},
         "LT":          {
             "function":     Exec.e_lt,         
+            "closure":      Closures.c_lt,
+            "transpile":    Transpiler.t_lt,
             "types":        ["var",      "symb",     "symb"    ],
             "data_types":   ["any",      "eq",       "eq"      ],
             "requirements": ["declared", "defined",  "defined" ]},
         "GT":          {
             "function":     Exec.e_gt,         
+            "closure":      Closures.c_gt,
+            "transpile":    Transpiler.t_gt,
             "types":        ["var",      "symb",     "symb"    ],
             "data_types":   ["any",      "eq",       "eq"      ],
             "requirements": ["declared", "defined",  "defined" ]},
         "EQ":          {
             "function":     Exec.e_eq,         
+            "closure":      Closures.c_eq,
+            "transpile":    Transpiler.t_eq,
             "types":        ["var",      "symb",     "symb"    ],
             "data_types":   ["any",      "eq",       "eq"      ],
             "requirements": ["declared", "defined",  "defined" ]},
         "AND":         {
             "function":     Exec.e_and,        
+            "closure":      Closures.c_and,
+            "transpile":    Transpiler.t_and,
             "types":        ["var",      "symb",     "symb"    ],
             "data_types":   ["any",      "bool",     "bool"    ],
             "requirements": ["declared", "defined",  "defined" ]},
         "OR":          {
             "function":     Exec.e_or,         
+            "closure":      Closures.c_or,
+            "transpile":    Transpiler.t_or,
             "types":        ["var",      "symb",     "symb"    ],
             "data_types":   ["any",      "bool",     "bool"    ],
             "requirements": ["declared", "defined",  "defined" ]},
         "NOT":         {
             "function":     Exec.e_not,        
+            "closure":      Closures.c_not,
+            "transpile":    Transpiler.t_not,
             "types":        ["var",      "symb"    ],
             "data_types":   ["any",      "bool"    ],
             "requirements": ["declared", "defined" ]},
         "INT2CHAR":    {
             "function":     Exec.e_int2char,   
+            "closure":      Closures.c_int2char,
+            "transpile":    Transpiler.t_int2char,
             "types":        ["var",      "symb"    ],
             "data_types":   ["any",      "int"     ],
             "requirements": ["declared", "defined" ]},
         "STRI2INT":    {
             "function":     Exec.e_stri2int,   
+            "closure":      Closures.c_stri2int,
+            "transpile":    Transpiler.t_stri2int,
             "types":        ["var",      "symb",     "symb"    ],
             "data_types":   ["any",      "string",   "int"     ],
             "requirements": ["declared", "defined",  "defined" ]},
         "READ":        {
             "function":     Exec.e_read,       
+            "closure":      Closures.c_read,
+            "transpile":    Transpiler.t_read,
             "types":        ["var",      "type"    ],
             "data_types":   ["any",      "any"     ],
             "requirements": ["declared", "defined" ]},
         "WRITE":       {
             "function":     Exec.e_write,      
+            "closure":      Closures.c_write,
+            "transpile":    Transpiler.t_write,
             "types":        ["symb"   ],
             "data_types":   ["any"    ],
             "requirements": ["defined"]},
         "CONCAT":      {
             "function":     Exec.e_concat,     
+            "closure":      Closures.c_concat,
+            "transpile":    Transpiler.t_concat,
             "types":        ["var",      "symb",     "symb"    ],
             "data_types":   ["any",      "string",   "string"  ],
             "requirements": ["declared", "defined",  "defined" ]},
         "STRLEN":      {
             "function":     Exec.e_strlen,     
+            "closure":      Closures.c_strlen,
+            "transpile":    Transpiler.t_strlen,
             "types":        ["var",      "symb"    ],
             "data_types":   ["any",      "string"  ],
             "requirements": ["declared", "defined" ]},
         "GETCHAR":     {
             "function":     Exec.e_getchar,    
+            "closure":      Closures.c_getchar,
+            "transpile":    Transpiler.t_getchar,
             "types":        ["var",      "symb",     "symb"    ],
             "data_types":   ["any",      "string",   "int"     ],
             "requirements": ["declared", "defined",  "defined" ]},
         "SETCHAR":     {
             "function":     Exec.e_setchar,    
+            "closure":      Closures.c_setchar,
+            "transpile":    Transpiler.t_setchar,
             "types":        ["var",      "symb",     "symb"    ],
             "data_types":   ["string",   "int",      "string"  ],
             "requirements": ["defined",  "defined",  "defined" ]},
         "TYPE":        {
             "function":     Exec.e_type,       
+            "closure":      Closures.c_type,
+            "transpile":    Transpiler.t_type,
             "types":        ["var",      "symb"    ],
             "data_types":   ["any",      "any"     ],
             "requirements": ["declared", "declared"]},
         "LABEL":       {
             "function":     Exec.e_label,      
+            "closure":      Closures.c_label,
+            "transpile":    Transpiler.t_label,
             "types":        ["label"   ],
             "data_types":   ["any"     ],
             "requirements": ["none"    ]},
         "JUMP":        {
             "function":     Exec.e_jump,       
+            "closure":      Closures.c_jump,
+            "transpile":    Transpiler.t_jump,
             "types":        ["label"   ],
             "data_types":   ["any"     ],
             "requirements": ["defined" ]},
         "JUMPIFEQ":    {
             "function":     Exec.e_jumpifeq,   
+            "closure":      Closures.c_jumpifeq,
+            "transpile":    Transpiler.t_jumpifeq,
             "types":        ["label",    "symb",     "symb"    ],
             "data_types":   ["any",      "any",      "any"     ],
             "requirements": ["defined",  "defined",  "defined" ]},
         "JUMPIFNEQ":   {
             "function":     Exec.e_jumpifneq,  
+            "closure":      Closures.c_jumpifneq,
+            "transpile":    Transpiler.t_jumpifneq,
             "types":        ["label",    "symb",     "symb"    ],
             "data_types":   ["any",      "any",      "any"     ],
             "requirements": ["defined",  "defined",  "defined" ]},
         "EXIT":        {
             "function":     Exec.e_exit,       
+            "closure":      Closures.c_exit,
+            "transpile":    Transpiler.t_exit,
             "types":        ["symb"    ],
             "data_types":   ["int"     ],
             "requirements": ["defined" ]},
         "DPRINT":      {
             "function":     Exec.e_dprint,     
+            "closure":      Closures.c_generic,
+            "transpile":    None,
             "types":        ["symb"    ],
             "data_types":   ["any"     ],
             "requirements": ["defined" ]},
         "BREAK":       {
             "function":     Exec.e_break,      
+            "closure":      Closures.c_generic,
+            "transpile":    None,
             "types":        [],
             "data_types":   [],
             "requirements": []},
         }
 
 
+# Opcodes of instructions which end a basic block (the following instruction
+# starts a new one)
+BLOCK_ENDS = ["JUMP", "JUMPIFEQ", "JUMPIFNEQ", "CALL", "RETURN", "EXIT"]
+
+
+# Patterns of sequences of instructions fused by the peephole optimization
+# (see Superinstructions), which are tried in this order
+FUSIONS = [
+        ("frame setup",     Superinstructions.frame_setup),
+        ("arithmetic jump", Superinstructions.arithmetic_jump),
+        ("push pop",        Superinstructions.push_pop),
+        ("move chain",      Superinstructions.move_chain),
+        ]
+
+
+# Opcodes of operations which are folded when all their operands are literals
+# (see Folding)
+FOLDABLE = ["ADD", "SUB", "MUL", "IDIV", "LT", "GT", "EQ", "AND", "OR", "NOT",
+        "INT2CHAR", "STRI2INT", "CONCAT", "STRLEN", "GETCHAR", "TYPE"]
+
+
+# Engines which can run a program (Program methods)
+ENGINES = {
+        "reference":  Program.run_all,
+        "closure":    Program.run_closures,
+        "transpiled": Program.run_transpiled,
+        }
+
+
 #
 #
 # MAIN
@@ -925,98 +3841,146 @@ if __name__ == "__main__":
     description = "A interpret for IPPcode22 represented by a XML file."
     source_help = (
             "Source code of a IPPcode22 program in XML format. If not "
-            + "provided, code will be read from standard input")
+            + "provided, code will be read from standard input. A file ending "
+            + "with .IPPcode22 is read as the source code itself (checked the "
+            + "same way as by parse.php) and a file ending with .ippc as "
+            + "bytecode")
     input_help = (
             "Input for the source code implementation. If not provided, input " 
             + "will be forwarded from standard input")
+    engine_help = (
+            "Engine used to run the program: reference (default), closure "
+            + "(instructions compiled to closures), transpiled (instructions "
+            + "transpiled to python) or diff (runs the program using all "
+            + "engines and checks that their outputs and exit codes are the "
+            + "same)")
+    profile_help = (
+            "Run the program using the reference engine while measuring how "
+            + "many times every instruction is executed and how long it takes, "
+            + "write the results to a JSON file and print the slowest opcodes "
+            + "and instructions to standard error output")
+    sample_help = (
+            "Run the program using the reference engine while sampling its "
+            + "call stack (labels called and the current instruction) and "
+            + "write the samples to a file in the collapsed stack format "
+            + "(for flamegraph tools)")
+    sample_interval_help = (
+            "Amount of steps between samples of the call stack (100 by "
+            + "default)")
+    output_help = (
+            "File where the output of the program is written. If not "
+            + "provided, output will be written to standard output. "
+            + "Directory where the outputs are written when used with "
+            + "--inputs")
+    output_buffer_help = (
+            "Amount of characters of the output collected before they are "
+            + "written (1048576 by default, 0 writes every WRITE immediately)")
+    batch_help = (
+            "Run all jobs of a manifest file, every line of which contains "
+            + "paths to the source, input and output files of a job (the "
+            + "error outputs and exit codes of the jobs are written to "
+            + "standard output as JSON lines)")
+    inputs_help = (
+            "Run the program on all input files in a directory or matching a "
+            + "glob pattern. The program is loaded only once and shared by "
+            + "processes running it, the output of every input file is "
+            + "written to the --output directory (as its name with .out) and "
+            + "the error outputs, exit codes and times of the runs are written "
+            + "to standard output as JSON lines")
+    jobs_help = (
+            "Amount of processes running the jobs of a batch or the inputs "
+            + "(the amount of CPUs by default)")
+    cache_dir_help = (
+            "Directory where prepared programs are cached (by a hash of the "
+            + "XML file), so the same program is only parsed and checked once")
+    emit_bytecode_help = (
+            "Write the program to a file in the bytecode format instead of "
+            + "running it. Programs in this format are loaded much faster "
+            + "(a source file ending with .ippc is loaded as bytecode)")
+    optimize_help = (
+            "Optimization level of the closure engine: 0 (default) or 1 "
+            + "(constants are folded and propagated and common sequences of "
+            + "instructions are fused to superinstructions, eg. -O1)")
+    fusion_report_help = (
+            "Print how many constants were folded and propagated and how "
+            + "many sequences of instructions were fused by the closure engine "
+            + "(by their patterns) to standard error output after the program "
+            + "is run")
+    cfg_dump_help = (
+            "Write the control flow graph of the program (its basic blocks "
+            + "and the jumps, calls and returns between them, after removing "
+            + "the unreachable code) to a file in the DOT format")
+    dump_source_help = (
+            "Write the source code of the program transpiled to python (as "
+            + "run by the transpiled engine) to a file")
     argparser = argparse.ArgumentParser(description=description)
     argparser.add_argument("--source", action="store", help=source_help)
     argparser.add_argument("--input", action="store", help=input_help)
+    argparser.add_argument("--engine", action="store", help=engine_help,
+            choices=list(ENGINES) + ["diff"], default="reference")
+    argparser.add_argument("-O", action="store", type=int, dest="optimize",
+            choices=[0, 1], default=0, help=optimize_help)
+    argparser.add_argument("--fusion-report", action="store_true",
+            help=fusion_report_help)
+    argparser.add_argument("--dump-source", action="store",
+            help=dump_source_help)
+    argparser.add_argument("--cfg-dump", action="store", help=cfg_dump_help)
+    argparser.add_argument("--emit-bytecode", action="store",
+            help=emit_bytecode_help)
+    argparser.add_argument("--cache-dir", action="store", help=cache_dir_help)
+    argparser.add_argument("--profile", action="store", help=profile_help)
+    argparser.add_argument("--sample", action="store", help=sample_help)
+    argparser.add_argument("--sample-interval", action="store", type=int,
+            default=100, help=sample_interval_help)
+    argparser.add_argument("--output", action="store", help=output_help)
+    argparser.add_argument("--output-buffer", action="store", type=int,
+            default=1 << 20, help=output_buffer_help)
+    argparser.add_argument("--batch", action="store", help=batch_help)
+    argparser.add_argument("--inputs", action="store", help=inputs_help)
+    argparser.add_argument("--jobs", action="store", type=int,
+            help=jobs_help)
     args = vars(argparser.parse_args())
-    if args["source"] == None and args["input"] == None:
-        err(0, "Please specify at least the source or input file (or both)")
-
-    # Program input is read from the standard input unless a file is specified
-    input_file = sys.stdin
-    if args["input"] != None:
-        try:
-            input_file = open(args["input"], "r")
-        except:
-            err(11, "Input file provided cannot be read")
-
-    # XML input is read from the standard input unless a file is specified
-    xml_file = sys.stdin
-    if args["source"] != None:
-        try:
-            xml_file = open(args["source"], "r")
-        except:
-            err(11, "XML file provided cannot be read")
 
     #
-    # Get the XML root element and check validity
+    # Run the interpret (errors and EXIT are raised as InterpretExit)
     #
 
     try:
-        xml_root = ET.ElementTree(ET.fromstring(xml_file.read())).getroot()
-    except:
-        err(31, "The XML provided is invalid")
-
-    # Check the root tag
-    if xml_root.tag != "program":
-        err(32, "Missing root element in the XML file")
-
-    # Check the language
-    if xml_root.attrib["language"].upper() != "IPPCODE22":
-        err(32, "Unrecognized language in the XML file")
-
-    # Check integrity of the elements of the XML root
-    for elem in xml_root.iter():
-
-        # Check for tags that are not allowed
-        allowed = ["instruction", "arg1", "arg2", "arg3", "name", "description"]
-        if elem != xml_root and elem.tag not in allowed:
-            err(32, "Invalid tag in the XML file: \"" + elem.tag + "\"")
-
-        # Order and opcode of an instruction needs to be specified
-        if (elem.tag == "instruction" and 
-                ("order" not in elem.attrib or "opcode" not in elem.attrib)):
-            err(32, "Received an instruction without opcode or order")
-
-        # Type of the argument needs to be specified
-        if elem.tag in ["arg1", "arg2", "arg3"] and "type" not in elem.attrib:
-            err(32, "Received an argument without type specified")
-
-
-    #
-    # Get all instructions in the XML root element
-    #
-
-    instructions = []
-    for xml_instr in xml_root:
-        if xml_instr.tag == "instruction":
-
-            # Parse the instruction by creating an object
-            parsed_instr = Instruction(
-                xml_instr.attrib["opcode"], 
-                xml_instr.attrib["order"]
-                )
-
-            # Append it to our array
-            instructions.append(parsed_instr)
-
-            # Add all the arguments
-            for xml_arg in xml_instr:
-                parsed_instr.add_arg(xml_arg)
-            parsed_instr.check_args()
-
-    #
-    # Initialize the program
-    #
-
-    program = Program(input_file, instructions)
-
-    #
-    # Run instructions until done
-    #
-
-    program.run_all()
+        if (args["source"] == None and args["input"] == None
+                and args["batch"] == None and args["inputs"] == None):
+            err(0, "Please specify at least the source or input file (or "
+                    + "both)")
+        for option in ["source", "input", "output", "profile", "sample",
+                "dump_source", "inputs", "emit_bytecode", "fusion_report",
+                "cfg_dump"]:
+            if args["batch"] != None and args[option] not in [None, False]:
+                err(10, "Option --" + option.replace("_", "-") + " cannot "
+                        + "be used along with --batch")
+        for option in ["input", "profile", "sample", "dump_source",
+                "emit_bytecode", "fusion_report", "cfg_dump"]:
+            if args["inputs"] != None and args[option] not in [None, False]:
+                err(10, "Option --" + option.replace("_", "-") + " cannot "
+                        + "be used along with --inputs")
+        if args["inputs"] != None and args["output"] == None:
+            err(10, "Option --inputs needs an output directory (--output)")
+        if args["profile"] != None and args["sample"] != None:
+            err(10, "Profiling and sampling cannot be used at once")
+        if ((args["profile"] != None or args["sample"] != None)
+                and args["engine"] != "reference"):
+            err(10, "Profiling is only supported by the reference engine")
+        if args["optimize"] > 0 and args["engine"] not in ["closure", "diff"]:
+            err(10, "Optimizations are only supported by the closure engine")
+        if args["fusion_report"] and args["engine"] != "closure":
+            err(10, "The fusion report is only supported by the closure "
+                    + "engine")
+        if args["sample_interval"] < 1:
+            err(10, "The sampling interval needs to be at least 1")
+
+        if args["batch"] != None:
+            run_batch(args)
+        elif args["inputs"] != None:
+            run_fanout(args)
+        else:
+            run_interpret(args)
+    except InterpretExit as e:
+        exit(report_exit(e, sys.stderr))
@@ -0,0 +1,91 @@
+# test_interpret.py
+# Tests of the parts of the interpret (interpret.py) which can't be tested by
+# test.php, eg. programs embedded in python and run as coroutines
+
+import asyncio
+import unittest
+
+import interpret
+
+
+# Get a program in XML format from a list of instructions, every one of them
+# being a tuple of its opcode and a list of its arguments (tuples of their
+# type and text)
+def program_xml(instructions):
+    lines = ["<?xml version=\"1.0\" encoding=\"UTF-8\"?>",
+            "<program language=\"IPPcode22\">"]
+    for order, (opcode, args) in enumerate(instructions, 1):
+        lines.append("<instruction order=\"" + str(order) + "\" opcode=\""
+                + opcode + "\">")
+        for i, (arg_type, text) in enumerate(args, 1):
+            lines.append("<arg" + str(i) + " type=\"" + arg_type + "\">"
+                    + text + "</arg" + str(i) + ">")
+        lines.append("</instruction>")
+    lines.append("</program>")
+    return "\n".join(lines).encode("utf-8")
+
+
+# A writer collecting all data written (like an asyncio.StreamWriter)
+class Writer:
+    def __init__(self):
+        self.data = b""
+
+
+    def write(self, data):
+        self.data += data
+
+
+    async def drain(self):
+        pass
+
+
+class TestRunAsync(unittest.TestCase):
+
+    # Run a coroutine, failing if it doesn't finish in a few seconds (the
+    # program is waiting for something that never comes)
+    def run_coroutine(self, coroutine):
+        return asyncio.run(asyncio.wait_for(coroutine, 5))
+
+
+    # The prompt needs to be written before the program waits for the input,
+    # which is only sent by the client once it sees the prompt
+    def test_prompt_before_read(self):
+        interpreter = interpret.Interpreter(program_xml([
+                ("DEFVAR", [("var", "GF@x")]),
+                ("WRITE",  [("string", "prompt:")]),
+                ("READ",   [("var", "GF@x"), ("type", "int")]),
+                ("WRITE",  [("var", "GF@x")])]))
+
+        async def client(reader, writer):
+            while b"prompt:" not in writer.data:
+                await asyncio.sleep(0)
+            reader.feed_data(b"42\n")
+
+        async def main():
+            reader = asyncio.StreamReader()
+            writer = Writer()
+            replying = asyncio.ensure_future(client(reader, writer))
+            code = await interpreter.run_async(reader, writer)
+            await replying
+            return code, writer.data
+
+        self.assertEqual(self.run_coroutine(main()), (0, b"prompt:42"))
+
+
+    # A program which never reads doesn't wait for the input at all (its end
+    # never comes)
+    def test_no_read(self):
+        interpreter = interpret.Interpreter(program_xml([
+                ("WRITE", [("string", "done")]),
+                ("EXIT",  [("int", "3")])]))
+
+        async def main():
+            writer = Writer()
+            code = await interpreter.run_async(asyncio.StreamReader(), writer)
+            return code, writer.data
+
+        self.assertEqual(self.run_coroutine(main()), (3, b"done"))
+
+
+if __name__ == "__main__":
+    unittest.main()